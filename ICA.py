@@ -1,50 +1,298 @@
 import numpy as np
-import pandas as pd
-from sklearn.decomposition import FastICA
-from scipy.signal import iirfilter, lfilter, windows
-from pyentrp import entropy as ent
 import csv
+import json
+import math
 import time
+import struct
+import argparse
+import glob
+import cProfile
+import functools
+import contextlib
+import socket
+import asyncio
 import statistics
-import traceback
+import logging
+import sys
+import bisect
 
 import threading
 import os
+import tempfile
 import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+class StdoutHandler(logging.StreamHandler):
+    # Looks sys.stdout up for every record, so redirect_stdout (batch workers) also captures the log
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+logger = logging.getLogger("ICA")
+
+def configure_logging(level="INFO"):
+    # level is a logging level name, or "quiet" to switch console output off completely
+    if not logger.handlers:
+        handler = StdoutHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.CRITICAL + 1 if str(level).lower() == "quiet" else str(level).upper())
+
+class StageTimings:
+    # Wall time of every named stage and running counters. Each worker fills its own
+    # instance, which the parent merges, so the summary covers every process of the run
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.counters = {}
+
+    def lap_timer(self):
+        # lap(name) records the time since the previous lap (or since lap_timer was called) under name
+        last = [time.perf_counter()]
+
+        def lap(name):
+            now = time.perf_counter()
+            self.times.setdefault(name, []).append(now - last[0])
+            last[0] = now
+
+        return lap
+
+    def add(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other, prefix=''):
+        # Stage times are pooled over all channels, counters are kept apart under prefix
+        for name, values in other.times.items():
+            self.times.setdefault(name, []).extend(values)
+        for name, n in other.counters.items():
+            self.count(prefix + name, n)
+
+    def summary(self):
+        lines = [f"{'stage':<24}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'total s':>10}"]
+        for name, values in self.times.items():
+            ms = np.array(values) * 1e3
+            lines.append(f"{name:<24}{len(ms):>7}{np.percentile(ms, 50):>10.2f}{np.percentile(ms, 95):>10.2f}"
+                         f"{ms.max():>10.2f}{ms.sum() / 1e3:>10.2f}")
+        lines.extend(f"{name:<24}{n:>7}" for name, n in sorted(self.counters.items()))
+        return "\n".join(lines)
+
+class NullTimings(StageTimings):
+    # Drop-in for StageTimings when instrumentation is off
+    enabled = False
+
+    def lap_timer(self):
+        return lambda name: None
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+no_timings = NullTimings()
+
+class BatchProfiler:
+    # Runs cProfile over batches first..last (inclusive) and writes the stats to path when the run ends.
+    # main() calls start/stop around every batch, so any object with the same three methods can take
+    # its place, e.g. to signal an external sampling profiler. With mode "process" the channel work
+    # happens in the workers and is not seen by a profiler in the parent, use "serial" for that
+    def __init__(self, first, last, path='ICA.prof'):
+        self.first = first
+        self.last = last
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self, batch_num):
+        if self.first <= batch_num <= self.last:
+            self.profile.enable()
+
+    def stop(self, batch_num):
+        if self.first <= batch_num <= self.last:
+            self.profile.disable()
+
+    def close(self):
+        self.profile.dump_stats(self.path)
+        logger.info("Profile of batches %d-%d written to %s", self.first, self.last, self.path)
 ########################################################################
 
 #parameters
 fs = 500 #Hz
 dt = 1/fs #s
-# Define filter coefficients
-b1 = pd.read_csv('filters/firhigh.csv').to_numpy().flatten()
-#b2 = pd.read_csv('filters/firfillow.csv').to_numpy().flatten()
-b2 = pd.read_csv('filters/low_60.csv').to_numpy().flatten()
+
+# Console output: a logging level name, or "quiet" for a silent throughput mode
+log_level = "INFO"
+configure_logging(log_level)
+
+# Sliding-window mode: the 3000-sample window is analysed again after every sliding_hop new samples,
+# so results update every hop instead of every 6 s. None analyses back-to-back batches.
+# Only what the new samples change is computed again: the filters and the R-peak searches take the new samples
+# (and a refractory margin before them), and the ICA of every channel is fit once every sliding_refit samples
+# and applied to the new rows in between, so the fit and sample entropy cost the same as for back-to-back batches
+sliding_hop = None
+sliding_refit = 3000
+
+# Per-stage timings and per-channel counters, summarised (p50/p95/max) at the end of a run
+collect_timings = True
+
+# Electrode columns of the recordings, in file order, and where each electrode sits
+channel_names = ('A','B','C','D')
+sensor_names = {'A': 'RIGHT', 'B': 'BOTTOM', 'C': 'LEFT', 'D': 'TOP'}
+# Order the channels are handed to the workers and reported in, and which channel wins when several
+# find the same number of foetal beats. Channels not listed come after the listed ones, in file order
+channel_order = ('B', 'D', 'A', 'C')
+fhr_precedence = ('A', 'C', 'B', 'D')
+mhr_precedence = ('A', 'C', 'D', 'B')
+best_ecg_precedence = ('D', 'B', 'C', 'A')
+
+# "channel": a 3-signal ICA per electrode. "multichannel": one ICA of all electrodes stacked together per batch
+separation_mode = "channel"
+# Add the main/residual signals of every electrode to the multichannel ICA input
+multichannel_derived = False
+
+# How the four channels of a batch are processed: "serial", "thread" or "process"
+channel_mode = "process"
+channel_workers = 4
+# Keep the filter state between batches instead of re-filtering the previous 2000 samples
+streaming_filters = True
+# Filter the channels of a batch together as one (channels, samples) stack before they are dispatched
+stacked_filters = True
+# ICA solver for the three derived signals: "fastica" (scikit-learn) or "fixed" (fixed number of FastICA iterations)
+ica_solver = "fastica"
+ica_fixed_iterations = 20
+# Start each batch's ICA from the previous batch's unmixing matrix
+ica_warm_start = True
+# Irregularity measure used to pick the fetal ICA component:
+# "sampen" (sample entropy, same values as pyentrp) or "turning_points" (cheap O(n) proxy)
+entropy_method = "sampen"
+# Binary recordings: a small header followed by raw little-endian int32 samples, one row per sample
+recording_magic = b'PXYECG01'
+recording_header = struct.Struct('<8sIIII')  # magic, header size, fs, bit depth, channel count
+recording_name_size = 16
+recording_extension = '.ecgbin'
+# FIR filters with at least this many taps are applied with FFT convolution instead of lfilter
+fft_min_taps = 400
+# Apply firhigh and low_60 as one precomputed kernel
+fuse_fir = True
+# Filter coefficients: the CSV designs and the precompiled bank built from them
+filter_dir = 'filters'
+filter_files = {'b1': 'firhigh.csv', 'b2': 'low_60.csv', 'notch': 'iirnotch.csv'}
+filter_bank_file = 'filter_bank.npz'
 
 nyquist = 0.5 * fs
 low = 47 / nyquist
 high = 53 / nyquist
-b3, a3 = iirfilter(N=3, Wn=[low, high], btype='bandstop', ftype='butter')
 
-fil = pd.read_csv('filters/iirnotch.csv', header=None)
-num = fil.iloc[:, 0].to_numpy().flatten()
-den = fil.iloc[:, 1].to_numpy().flatten()
+class FilterBank:
+    # All filter coefficients of the pipeline. Built on first use, not at import, so worker
+    # processes and CLI commands that never filter do not pay for pandas, scipy or the CSVs
+    names = ('b1', 'b2', 'b3', 'a3', 'b12', 'num', 'den')
+
+    def __init__(self, b1, b2, b3, a3, num, den, b12=None):
+        self.b1 = b1
+        self.b2 = b2
+        self.b3 = b3
+        self.a3 = a3
+        self.num = num
+        self.den = den
+        # firhigh followed by low_60 as a single kernel
+        self.b12 = np.convolve(b1, b2) if b12 is None else b12
+
+    @classmethod
+    def from_csv(cls, directory=filter_dir):
+        import pandas as pd
+        from scipy.signal import iirfilter
+
+        b1 = pd.read_csv(os.path.join(directory, filter_files['b1'])).to_numpy().flatten()
+        #b2 = pd.read_csv('filters/firfillow.csv').to_numpy().flatten()
+        b2 = pd.read_csv(os.path.join(directory, filter_files['b2'])).to_numpy().flatten()
+        b3, a3 = iirfilter(N=3, Wn=[low, high], btype='bandstop', ftype='butter')
+
+        fil = pd.read_csv(os.path.join(directory, filter_files['notch']), header=None)
+        num = fil.iloc[:, 0].to_numpy().flatten()
+        den = fil.iloc[:, 1].to_numpy().flatten()
+        return cls(b1, b2, b3, a3, num, den)
+
+    @classmethod
+    def from_npz(cls, path):
+        with np.load(path) as bank:
+            return cls(**{name: bank[name] for name in cls.names})
+
+    def save_npz(self, path):
+        # Written next to path and renamed into place, so an interrupted run or two processes saving
+        # at once never leave a half-written bank behind
+        fd, temp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{name: getattr(self, name) for name in self.names})
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+def filter_bank_is_fresh(directory=filter_dir):
+    # The precompiled bank is used while it is newer than every CSV it was built from
+    path = os.path.join(directory, filter_bank_file)
+    if not os.path.exists(path):
+        return False
+    sources = [os.path.join(directory, name) for name in filter_files.values()]
+    return all(os.path.getmtime(source) <= os.path.getmtime(path) for source in sources if os.path.exists(source))
+
+@functools.lru_cache(maxsize=None)
+def get_filter_bank(directory=filter_dir):
+    # One bank per process: load the .npz when it is up to date, otherwise design from the CSVs and refresh it
+    path = os.path.join(directory, filter_bank_file)
+    if filter_bank_is_fresh(directory):
+        try:
+            return FilterBank.from_npz(path)
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning("Rebuilding %s, it could not be read: %s", path, e)
+
+    bank = FilterBank.from_csv(directory)
+    try:
+        bank.save_npz(path)
+    except OSError as e:
+        logger.debug("Could not write %s: %s", path, e)
+    return bank
+
+def __getattr__(name):
+    # b1, b2, b3, a3, b12, num and den used to be module globals built at import time
+    if name in FilterBank.names:
+        return getattr(get_filter_bank(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def init_worker():
+    # Pool initializer: load the filter bank once per worker instead of in its first task
+    get_filter_bank()
 
 ######################################################################
-def rep_zeros(arr):  
-    # Find indices where the array is 0
-    zero_indices = np.where(arr == 0)[0]
-    
-    # Loop through zero indices and replace each zero with the average of its neighbors
-    for inx in zero_indices:
-        left_neighbor = arr[inx - 1] if inx > 0 else 0
-        right_neighbor = arr[inx + 1] if inx < len(arr) - 1 else 0
-        avg = (left_neighbor + right_neighbor) // 2
-        arr[inx] = avg
+def fill_zero_runs(arr):
+    # Linearly interpolate every run of zeros between the nearest non-zero samples on either side.
+    # Zeros before the first or after the last non-zero sample have nothing to interpolate from and stay zero
+    support = np.flatnonzero(arr)
+    if len(support) < 2:
+        return arr
+
+    zero_indices = np.flatnonzero(arr == 0)
+    inner = zero_indices[(zero_indices > support[0]) & (zero_indices < support[-1])]
+    arr[inner] = np.interp(inner, support, arr[support])
     return arr
 
+def rep_zeros(arr):  
+    # Replace each zero with the interpolation of its nearest non-zero neighbours
+    return fill_zero_runs(arr)
+
 # Function to calculate threshold
 def calculate_threshold(column):
     mean = np.mean(abs(column))  # Calculate mean
@@ -54,7 +302,6 @@ def calculate_threshold(column):
 
 # #Function to identify invalid rows
 def find_invalid_rows(df, threshold_A ,threshold_B,threshold_C,threshold_D   ):
-    print()
     return (abs(df['A']) > threshold_A ) | (abs(df['B']) > threshold_B) | (abs(df['C']) > threshold_C) | (abs(df['D']) > threshold_D)
 
 # Function to replace invalid rows with interpolated values
@@ -76,58 +323,241 @@ def clean_invalid_blocks(df, threshold_A ,threshold_B,threshold_C,threshold_D):
     #print(df_cleaned)
     return df_cleaned,invalid_indexes
 
-def remove_outliers(data):
-    chunk_size = 300
-    data_copy = data.copy()
-
-    for i in range(0, len(data), chunk_size):
-        # Define the chunk
-        chunk = data_copy[i:i + chunk_size]
-        
-        # Calculate Q1 and Q3 manually
-        sorted_chunk = np.sort(chunk)
-        n = len(sorted_chunk)
-        Q1 = sorted_chunk[int(0.25 * n)]  # 25th percentile
-        Q3 = sorted_chunk[int(0.75 * n)]  # 75th percentile
-        
-        # Calculate IQR
-        IQR = Q3 - Q1
-        
-        # Define outlier thresholds
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        
-        # Find the indices of the outliers
-        outliers_indices = np.where((chunk < lower_bound) | (chunk > upper_bound))[0]
-        
-        # Replace outliers while handling consecutive outliers
-        for idx in outliers_indices:
-            if idx == 0:
-                # If the first element is an outlier, use the next valid value
-                if idx + 1 not in outliers_indices:
-                    chunk[idx] = chunk[idx + 1]
-            elif idx == len(chunk) - 1:
-                # If the last element is an outlier, use the previous valid value
-                if idx - 1 not in outliers_indices:
-                    chunk[idx] = chunk[idx - 1]
-            else:
-                # Check if neighbors are valid (not outliers)
-                if (idx - 1 not in outliers_indices) and (idx + 1 not in outliers_indices):
-                    # Replace with the average of neighbors if both are valid
-                    chunk[idx] = (chunk[idx - 1] + chunk[idx + 1]) / 2
-                elif idx - 1 not in outliers_indices:
-                    # If only the previous neighbor is valid
-                    chunk[idx] = chunk[idx - 1]
-                elif idx + 1 not in outliers_indices:
-                    # If only the next neighbor is valid
-                    chunk[idx] = chunk[idx + 1]
-
-        # Update the original data with the processed chunk
-        data_copy[i:i + chunk_size] = chunk
+def clean_invalid_block_array(block):
+    # Same artifact rejection as clean_invalid_blocks on a (n_samples, n_channels) int array:
+    # the thresholds of all channels come from one reduction, and rows where any channel is over
+    # its threshold are refilled by one linear interpolation per channel (nearest value at the edges).
+    # invalid_indexes are row numbers within the block
+    magnitude = np.abs(block)
+    thresholds = np.mean(magnitude, axis=0) + 4 * np.std(magnitude, axis=0)
+    invalid_mask = np.any(magnitude > thresholds, axis=1)
+
+    cleaned = block.astype(int)
+    invalid_indexes = np.flatnonzero(invalid_mask)
+    valid_indexes = np.flatnonzero(~invalid_mask)
+    if len(invalid_indexes) and len(valid_indexes):
+        for channel in range(block.shape[1]):
+            cleaned[invalid_indexes, channel] = np.round(np.interp(invalid_indexes, valid_indexes, block[valid_indexes, channel]))
+
+    return cleaned, invalid_indexes
+
+def remove_outliers(data, chunk_size=300, out=None):
+    # data is one channel or a (channels, samples) stack, split into chunks along the last axis.
+    # out is an optional array of the same shape and dtype to work in instead of a copy of data
+    if out is None:
+        data_copy = data.copy()
+    else:
+        np.copyto(out, data)
+        data_copy = out
+
+    # All full chunks are handled together as rows of a 2-D array, the short tail chunks on their own.
+    # For a stack the column slices are not contiguous and reshape copies them, hence the write-back
+    n = data_copy.shape[-1]
+    n_full = n - n % chunk_size
+    if n_full:
+        chunks = data_copy[..., :n_full].reshape(-1, chunk_size)
+        replace_chunk_outliers(chunks)
+        data_copy[..., :n_full] = chunks.reshape(data_copy.shape[:-1] + (n_full,))
+    if n_full < n:
+        chunks = data_copy[..., n_full:].reshape(-1, n - n_full)
+        replace_chunk_outliers(chunks)
+        data_copy[..., n_full:] = chunks.reshape(data_copy.shape[:-1] + (n - n_full,))
 
     return data_copy
 
-def quantized_value_to_voltage(quantized_value, v_min=-3.3, v_max=3.3, bit_depth=24):
+def replace_chunk_outliers(chunks):
+    # chunks is a (n_chunks, chunk_size) view that is updated in place
+    n = chunks.shape[1]
+
+    # Q1 and Q3 of every chunk, picked the same way as sorting each chunk
+    q1_pos, q3_pos = int(0.25 * n), int(0.75 * n)
+    partitioned = np.partition(chunks, (q1_pos, q3_pos), axis=1)
+    Q1 = partitioned[:, q1_pos:q1_pos + 1]
+    Q3 = partitioned[:, q3_pos:q3_pos + 1]
+
+    # Define outlier thresholds
+    IQR = Q3 - Q1
+    lower_bound = Q1 - 1.5 * IQR
+    upper_bound = Q3 + 1.5 * IQR
+    outliers = (chunks < lower_bound) | (chunks > upper_bound)
+
+    # A neighbour is usable if it is inside the chunk and not an outlier itself
+    prev_valid = np.zeros_like(outliers)
+    prev_valid[:, 1:] = ~outliers[:, :-1]
+    next_valid = np.zeros_like(outliers)
+    next_valid[:, :-1] = ~outliers[:, 1:]
+
+    prev_vals = np.zeros_like(chunks)
+    prev_vals[:, 1:] = chunks[:, :-1]
+    next_vals = np.zeros_like(chunks)
+    next_vals[:, :-1] = chunks[:, 1:]
+
+    # Average of both valid neighbours, otherwise the one valid neighbour, otherwise leave it
+    both = outliers & prev_valid & next_valid
+    only_prev = outliers & prev_valid & ~next_valid
+    only_next = outliers & next_valid & ~prev_valid
+
+    chunks[both] = (prev_vals[both] + next_vals[both]) / 2
+    chunks[only_prev] = prev_vals[only_prev]
+    chunks[only_next] = next_vals[only_next]
+
+def fir_filter(b, x, history=None):
+    # Same output as lfilter(b, [1], x), with history holding the last len(b)-1 inputs of the previous call
+    n_hist = len(b) - 1
+    if history is None:
+        history = np.zeros(x.shape[:-1] + (n_hist,))
+
+    padded = np.concatenate((history, x), axis=-1)
+    return fir_convolve(b, padded), padded[..., padded.shape[-1] - n_hist:]
+
+def fir_convolve(b, padded):
+    # 'valid' convolution along the last axis, for one channel or a (channels, samples) stack.
+    # Long filters go through overlap-add FFT convolution, short ones through direct convolution
+    if len(b) >= fft_min_taps:
+        from scipy.signal import oaconvolve
+        return oaconvolve(padded, b.reshape((1,) * (padded.ndim - 1) + (-1,)), mode='valid', axes=-1)
+    if padded.ndim == 1:
+        return np.convolve(padded, b, mode='valid')
+    return np.stack([np.convolve(row, b, mode='valid') for row in padded])
+
+def fir_kernels(fuse=fuse_fir):
+    # The FIR stages of the chain, either as the fused kernel or as firhigh followed by low_60
+    bank = get_filter_bank()
+    return [bank.b12] if fuse else [bank.b1, bank.b2]
+
+class ScratchArrays:
+    # Work arrays reused from batch to batch while their shape and dtype stay the same.
+    # They hold nothing that has to survive a batch, so they are not pickled to the workers
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name, shape, dtype=float):
+        array = self.arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = self.arrays[name] = np.empty(shape, dtype)
+        return array
+
+    def __reduce__(self):
+        return ScratchArrays, ()
+
+class HistoryBuffer:
+    # The raw samples of the previous batch that the non-streaming filters run over again, kept in
+    # front of the new batch in one preallocated array instead of being concatenated every batch
+    def __init__(self, size=2000):
+        self.size = size
+        self.buffer = None
+        self.length = 0
+
+    def reset(self):
+        self.length = 0
+
+    def push(self, x):
+        # Returns the last size samples pushed before followed by x, as a view that is valid until the next push
+        keep = min(self.size, self.length)
+        if self.buffer is None or len(self.buffer) < keep + len(x) or self.buffer.dtype != x.dtype:
+            old = self.buffer
+            self.buffer = np.empty(self.size + len(x), dtype=x.dtype)
+            if keep:
+                self.buffer[:keep] = old[self.length - keep:self.length]
+        elif keep:
+            self.buffer[:keep] = self.buffer[self.length - keep:self.length]
+
+        self.buffer[keep:keep + len(x)] = x
+        self.length = keep + len(x)
+        return self.buffer[:self.length]
+
+class StreamingFilterChain:
+    # High-pass FIR -> low_60 FIR -> Butterworth bandstop, with the state of every
+    # stage kept between batches so each sample is filtered exactly once.
+    # Takes one channel or a (channels, samples) stack, which is filtered along the last axis in one call per stage
+    def __init__(self, fuse=fuse_fir):
+        self.firs = fir_kernels(fuse)
+        bank = get_filter_bank()
+        self.b3, self.a3 = bank.b3, bank.a3
+        self.history = None
+        self.zi = None
+        # History followed by the new samples, one buffer per FIR stage, kept while the batch shape stays the same
+        self.buffers = ScratchArrays()
+
+    def reset(self):
+        self.history = None
+        self.zi = None
+
+    def initial_state(self, x0):
+        # Start each stage in steady state for a constant input, so the ADC offset does not ring through the filters
+        history = []
+        level = x0
+        for b in self.firs:
+            history.append(np.multiply.outer(level, np.ones(len(b) - 1)))
+            level = level * np.sum(b)
+        from scipy.signal import lfilter_zi
+        zi = np.multiply.outer(level, lfilter_zi(self.b3, self.a3))
+        return history, zi
+
+    def filter(self, x):
+        from scipy.signal import lfilter
+        if self.zi is None:
+            self.history, self.zi = self.initial_state(x[..., 0])
+
+        y = x
+        for i, b in enumerate(self.firs):
+            n_hist = len(b) - 1
+            padded = self.buffers.get(i, y.shape[:-1] + (n_hist + y.shape[-1],))
+            padded[..., :n_hist] = self.history[i]
+            padded[..., n_hist:] = y
+            y = fir_convolve(b, padded)
+            self.history[i][...] = padded[..., -n_hist:]
+        y, self.zi = lfilter(self.b3, self.a3, y, axis=-1, zi=self.zi)
+        return y
+
+class SlidingWindow:
+    # The last size filtered samples of one channel, or of a (channels, samples) stack. Only the new samples
+    # go through the StreamingFilterChain, and filter returns the updated window, so it stands in for the chain
+    def __init__(self, size=3000, fuse=fuse_fir):
+        self.chain = StreamingFilterChain(fuse)
+        self.size = size
+        self.samples = None
+        self.filled = 0
+
+    def reset(self):
+        self.chain.reset()
+        self.samples = None
+        self.filled = 0
+
+    def filter(self, x):
+        # The window is one preallocated array: older samples shift left and the new ones go at the end.
+        # The returned view is valid until the next call
+        y = self.chain.filter(x)
+        if self.samples is None or self.samples.shape[:-1] != y.shape[:-1]:
+            self.samples = np.empty(y.shape[:-1] + (self.size,))
+            self.filled = 0
+
+        n = min(y.shape[-1], self.size)
+        self.samples[..., :self.size - n] = self.samples[..., n:]
+        self.samples[..., self.size - n:] = y[..., y.shape[-1] - n:]
+        self.filled = min(self.filled + n, self.size)
+        return self.samples[..., self.size - self.filled:]
+
+class RawWindow:
+    # The last size raw (rows, channels) samples of a sliding session, so the artifact thresholds come from
+    # the whole window and not just the hop of new rows. push returns a view that is valid until the next push
+    def __init__(self, size=3000):
+        self.size = size
+        self.rows = None
+        self.filled = 0
+
+    def push(self, rows):
+        if self.rows is None or self.rows.shape[1:] != rows.shape[1:] or self.rows.dtype != rows.dtype:
+            self.rows = np.empty((self.size,) + rows.shape[1:], dtype=rows.dtype)
+            self.filled = 0
+
+        n = min(len(rows), self.size)
+        self.rows[:self.size - n] = self.rows[n:]
+        self.rows[self.size - n:] = rows[len(rows) - n:]
+        self.filled = min(self.filled + n, self.size)
+        return self.rows[self.size - self.filled:]
+
+def quantized_value_to_voltage(quantized_value, v_min=-3.3, v_max=3.3, bit_depth=24, out=None):
  
     # Number of quantization levels
     num_levels = 2**bit_depth - 1  # Exclude the 0 value for signed integer representation
@@ -136,10 +566,155 @@ def quantized_value_to_voltage(quantized_value, v_min=-3.3, v_max=3.3, bit_depth
     step_size = (v_max - v_min) / num_levels
     
     # Convert quantized value back to voltage
+    if out is not None:
+        # Same operations, written into a float array of the same shape instead of three temporaries
+        np.multiply(quantized_value, step_size, out=out)
+        np.add(out, v_min, out=out)
+        return np.multiply(out, 1e3, out=out)
     voltage = quantized_value * step_size + v_min
     
     return voltage*1e3
 
+def sym_decorrelation(W):
+    # W <- (W W^T)^(-1/2) W
+    s, u = np.linalg.eigh(np.dot(W, W.T))
+    s = np.clip(s, np.finfo(W.dtype).tiny, None)
+    return np.linalg.multi_dot([u * (1.0 / np.sqrt(s)), u.T, W])
+
+def fixed_point_ica(data, n_components=2, n_iter=ica_fixed_iterations, w_init=None):
+    # Parallel FastICA (logcosh) with the same eigh whitening as scikit-learn's arbitrary-variance mode,
+    # but a fixed iteration count and no convergence test. data is (n_samples, n_signals).
+    # Returns the components, the unmixing matrix W and the mean and W.K that project any data onto the components
+    mean = np.mean(data, axis=0)
+    XT = data.T - mean[:, np.newaxis]
+    n_samples = XT.shape[1]
+
+    d, u = np.linalg.eigh(np.dot(XT, XT.T))
+    order = np.argsort(d)[::-1][:n_components]
+    d = np.sqrt(np.maximum(d[order], np.finfo(d.dtype).eps * 10))
+    u = u[:, order] * np.sign(u[0, order])
+    K = (u / d).T
+    X1 = np.dot(K, XT) * np.sqrt(n_samples)
+
+    if w_init is None:
+        w_init = np.random.normal(size=(n_components, n_components))
+    W = sym_decorrelation(w_init)
+    for _ in range(n_iter):
+        gwtx = np.tanh(np.dot(W, X1))
+        g_wtx = np.mean(1 - gwtx ** 2, axis=1)
+        W = sym_decorrelation(np.dot(gwtx, X1.T) / n_samples - g_wtx[:, np.newaxis] * W)
+
+    projection = np.dot(W, K)
+    return np.dot(projection, XT).T, W, mean, projection
+
+class IcaStage:
+    # Two-component ICA of one channel, or n_components for the multichannel mode. With warm_start the
+    # unmixing matrix found for one batch is the starting point for the next, consecutive windows being highly correlated.
+    # transform applies the last fit to other samples
+    def __init__(self, solver=ica_solver, warm_start=ica_warm_start, n_iter=ica_fixed_iterations, n_components=2):
+        self.solver = solver
+        self.warm_start = warm_start
+        self.n_iter = n_iter
+        self.n_components = n_components
+        self.w_init = None
+        self.mean = None
+        self.projection = None
+
+    def reset(self):
+        self.w_init = None
+        self.mean = None
+        self.projection = None
+
+    def fit_transform(self, data):
+        # data is (n_samples, n_signals), returns the (n_samples, n_components) independent components
+        if self.solver == "fastica":
+            from sklearn.decomposition import FastICA
+            ica = FastICA(n_components=self.n_components, whiten="arbitrary-variance", whiten_solver="eigh", w_init=self.w_init)
+            components = ica.fit_transform(data)
+            # components_ is W.K, recover the unmixing matrix W of the whitened space
+            unmixing = np.dot(ica.components_, np.linalg.pinv(ica.whitening_))
+            self.mean, self.projection = ica.mean_, ica.components_
+        elif self.solver == "fixed":
+            components, unmixing, self.mean, self.projection = fixed_point_ica(data, self.n_components, self.n_iter, self.w_init)
+        else:
+            raise ValueError(f"Unknown ICA solver: {self.solver}")
+
+        if self.warm_start:
+            self.w_init = unmixing
+        return components
+
+    def transform(self, data):
+        # The components of data (n_samples, n_signals) under the unmixing of the last fit_transform
+        return np.dot(data - self.mean, self.projection.T)
+
+def sample_entropy(time_series, sample_length, tolerance=None):
+    # Same values as pyentrp.entropy.sample_entropy: Chebyshev distance, strict tolerance
+    # (default 0.1 * std) and the same template range, returned as an array of sample_length values
+    x = np.asarray(time_series, dtype=float)
+    if tolerance is None:
+        tolerance = 0.1 * np.std(x)
+
+    n = len(x)
+    n_templates = n - sample_length + 1
+
+    counts = np.zeros(sample_length + 1)
+    counts[0] = n * (n - 1) / 2
+    if sample_length == 1:
+        counts[1] = count_close_pairs(x[:n_templates], tolerance)
+    else:
+        counts[1:] = count_matching_templates(x, n_templates, sample_length, tolerance)
+
+    return -np.log(counts[1:] / counts[:-1])
+
+def count_close_pairs(values, tolerance):
+    # Number of pairs with |a - b| < tolerance, counted on the sorted values in O(n log n).
+    # searchsorted gives the end of each window, which is then nudged so the test is the
+    # same rounded difference pyentrp compares, keeping the counts exact
+    w = np.sort(values)
+    p = np.arange(len(w))
+    end = np.maximum(np.searchsorted(w, w + tolerance), p + 1)
+
+    while True:
+        grow = end < len(w)
+        grow[grow] = w[end[grow]] - w[grow] < tolerance
+        if not grow.any():
+            break
+        end[grow] += 1
+
+    while True:
+        shrink = end > p + 1
+        shrink[shrink] = w[end[shrink] - 1] - w[shrink] >= tolerance
+        if not shrink.any():
+            break
+        end[shrink] -= 1
+
+    return np.sum(end - p - 1)
+
+def count_matching_templates(x, n_templates, sample_length, tolerance, block=256):
+    # Pairs of templates matching on their first 1..sample_length samples, checked a block of rows at a time
+    counts = np.zeros(sample_length)
+    for start in range(0, n_templates - 1, block):
+        rows = np.arange(start, min(start + block, n_templates - 1))
+        match = np.arange(n_templates)[np.newaxis, :] > rows[:, np.newaxis]
+        for k in range(sample_length):
+            match &= np.abs(x[k:k + n_templates][np.newaxis, :] - x[rows + k][:, np.newaxis]) < tolerance
+            counts[k] += np.count_nonzero(match)
+    return counts
+
+def turning_point_rate(signal):
+    # Share of samples that are a local maximum or minimum, a linear-time stand-in for sample entropy
+    d = np.diff(signal)
+    return np.mean(d[:-1] * d[1:] < 0)
+
+def component_irregularity(signal, method=None):
+    # Higher means more irregular, used to tell the fetal component from the maternal one
+    method = method or entropy_method
+    if method == "sampen":
+        return sample_entropy(signal, 1)
+    if method == "turning_points":
+        return turning_point_rate(signal)
+    raise ValueError(f"Unknown entropy method: {method}")
+
 # Signal Processing Function definitions
 def adt_findrpeaks(ecg_signal, threshold_ratio=0.45, refractory_period = 150, integration_window =35):
     # Differentiation
@@ -147,10 +722,6 @@ def adt_findrpeaks(ecg_signal, threshold_ratio=0.45, refractory_period = 150, in
 
     # Squaring
     squared_signal = differentiated_signal ** 2
-    
-    window_size = integration_window*2
-
-    window = windows.flattop(window_size)
 
     # Integration
     # integrated_signal = np.convolve(squared_signal, np.ones(integration_window)/integration_window, mode='same')
@@ -163,19 +734,26 @@ def adt_findrpeaks(ecg_signal, threshold_ratio=0.45, refractory_period = 150, in
     high_threshold = threshold_ratio * np.max(integrated_signal)
 
     # QRS Detection
-    r_indices = []
-    in_refractory_period = False
-
-    for i, value in enumerate(integrated_signal):
-        if value > high_threshold and not in_refractory_period:
-            r_indices.append(i)
-            in_refractory_period = True
-
-        if in_refractory_period and i - r_indices[-1] >= refractory_period:
-            in_refractory_period = False
+    r_indices = threshold_crossings(integrated_signal, high_threshold, refractory_period)
             
     return r_indices, integrated_signal, high_threshold
 
+def threshold_crossings(integrated_signal, high_threshold, refractory_period):
+    # Samples above the threshold, keeping only the first one of every refractory period.
+    # A new peak needs to be more than refractory_period samples after the previous one,
+    # so jump straight to the next such candidate instead of stepping through every sample
+    candidates = np.flatnonzero(integrated_signal > high_threshold)
+    gap = max(refractory_period, 0) + 1
+
+    r_indices = []
+    pos = 0
+    while pos < len(candidates):
+        idx = candidates[pos]
+        r_indices.append(int(idx))
+        pos = np.searchsorted(candidates, idx + gap)
+
+    return r_indices
+
 def correct_sign(signal):
     #signal should be a numpy array
     peak = np.max(signal)
@@ -201,19 +779,7 @@ def get_hrlis(signal,end_f, threshold_ratio = 0.7, refractory_period=100):
     r_indices_1,integrated,  _ = adt_findrpeaks(signal, threshold_ratio = threshold_ratio, refractory_period=refractory_period)
     r_indices = [pos_prev] + r_indices_1
 
- 
-
-
-    delta_lis = []
-    num_vals = len(r_indices)-1
-    
-    for i in range(1,num_vals):
-        T1 = 1 / (r_indices[i] - r_indices[i-1])
-        T2 = 1 / (r_indices[i+1] - r_indices[i])
-        delta_t = ((T1 + T2)/2)
-        delta_lis.append(delta_t)
-
-    hr_bpm = [int(30000*x) for x in delta_lis]
+    hr_bpm = interval_rates(r_indices)
 
     hr_vals = hr_bpm.copy()
 
@@ -226,6 +792,158 @@ def get_hrlis(signal,end_f, threshold_ratio = 0.7, refractory_period=100):
     
     return hr_bpm, r_indices, np.mean(np.array(hr_vals)), np.std(np.array(hr_vals)), hr_vals, integrated, end_pos
 
+def interval_rates(r_indices):
+    # bpm at every peak but the first and the last, from the mean of the rates of the intervals on either side
+    delta_lis = []
+    num_vals = len(r_indices)-1
+    
+    for i in range(1,num_vals):
+        T1 = 1 / (r_indices[i] - r_indices[i-1])
+        T2 = 1 / (r_indices[i+1] - r_indices[i])
+        delta_t = ((T1 + T2)/2)
+        delta_lis.append(delta_t)
+
+    return [int(30000*x) for x in delta_lis]
+
+class PeakTrack:
+    # The R peaks of a sliding window, found like adt_findrpeaks but carried from one window to the next:
+    # only the samples that changed are integrated again, and peaks are only searched again from a margin
+    # before them, as a peak that moves can shift the refractory period of the ones after it.
+    # Peaks are absolute sample positions, before is the last one that left the window
+    __slots__ = ('threshold_ratio', 'refractory_period', 'integration_window', 'margin',
+                 'integrated', 'threshold', 'start', 'redo', 'peaks', 'before')
+
+    def __init__(self, threshold_ratio=0.45, refractory_period=150, integration_window=35):
+        self.threshold_ratio = threshold_ratio
+        self.refractory_period = refractory_period
+        self.integration_window = integration_window
+        self.margin = refractory_period + integration_window
+        self.integrated = None
+        self.threshold = None
+        self.start = None
+        self.redo = 0
+        self.peaks = []
+        self.before = None
+
+    def update(self, signal, start, changed=None):
+        # signal is the whole window and start its absolute position. changed is how many samples at the end
+        # of the window differ from the last update, by default the ones that are new since then
+        n = len(signal) - 1
+        shift = n + 1 if self.start is None else start - self.start
+        changed = shift if changed is None else changed
+        half = self.integration_window // 2 + 1
+        kernel = np.ones(self.integration_window) / self.integration_window
+
+        if self.integrated is None or len(self.integrated) != n or changed + 3 * half >= n:
+            self.integrated = np.convolve(np.square(np.diff(signal)), kernel, mode='same')
+            redo = 0
+        else:
+            # The integrated samples that did not change move left with the window, the window of the
+            # integration reaches half samples either side, so the ones next to a changed sample are redone,
+            # and so are the first ones, where the integration window now runs over the start of the window
+            self.integrated[:n - shift] = self.integrated[shift:]
+            self.integrated[:half] = np.convolve(np.square(np.diff(signal[:3 * half])), kernel, mode='same')[:half]
+            first = n - changed - half
+            lo = first - half
+            self.integrated[first:] = np.convolve(np.square(np.diff(signal[lo:])), kernel, mode='same')[first - lo:]
+            redo = max(first - self.margin, 0)
+
+        # Peaks that left the window, the last of them opens the first beat interval of the window
+        gone = bisect.bisect_left(self.peaks, start)
+        if gone:
+            self.before = self.peaks[gone - 1]
+        self.peaks = self.peaks[gone:bisect.bisect_left(self.peaks, start + redo)]
+        self.start = start
+
+        # The threshold follows the maximum of the whole window. When it moves, the peaks before redo
+        # only change if a sample there lies between the old and the new threshold
+        threshold = self.threshold_ratio * np.max(self.integrated)
+        if redo and threshold != self.threshold:
+            low, high = sorted((threshold, self.threshold))
+            settled = self.integrated[:redo]
+            if np.any((settled > low) & (settled <= high)):
+                redo = 0
+                self.peaks = []
+        self.threshold = threshold
+        self.redo = redo
+
+        begin = redo
+        if self.peaks:
+            begin = max(begin, self.peaks[-1] - start + self.refractory_period + 1)
+        self.peaks.extend(start + begin + p for p in threshold_crossings(self.integrated[begin:], threshold, self.refractory_period))
+
+    def window_peaks(self):
+        # The peaks relative to the window
+        return [p - self.start for p in self.peaks]
+
+    def rates(self):
+        # What get_hrlis returns for the window: the rates, the peaks with the last one before the window
+        # first (or -3000 like for the first batch) and the last peak
+        r_indices = [-3000 if self.before is None else self.before - self.start] + self.window_peaks()
+        return interval_rates(r_indices), r_indices, r_indices[-1]
+
+    def hrlis(self, signal, start, changed=None):
+        self.update(signal, start, changed)
+        return self.rates()
+
+class ComponentTrack:
+    # The ICA components of a sliding window with a PeakTrack for each. The ICA is fit again once every
+    # refit_every new samples, as often as for back-to-back batches, and in between the last fit is applied
+    # to the rows of the window that changed. The signs correct_sign picks are kept from the last fit too,
+    # so the carried peaks stay on the same side of every component
+    __slots__ = ('refit_every', 'components', 'signs', 'peaks', 'start', 'since_fit')
+
+    def __init__(self, n_components=2, refit_every=sliding_refit):
+        self.refit_every = refit_every
+        self.components = None
+        self.signs = None
+        self.peaks = [PeakTrack(0.4, 160) for _ in range(n_components)]
+        self.start = None
+        self.since_fit = 0
+
+    def update(self, ica, data, start, changed):
+        # data is the (samples, signals) ICA input of the window starting at start, changed how many of its
+        # last rows differ from the last update. Returns the components cut to [50:-50] like process_of_code,
+        # and whether the ICA was fit again
+        n = len(data)
+        shift = n if self.start is None else start - self.start
+        self.since_fit += shift
+        self.start = start
+
+        refit = self.components is None or len(self.components) != n or self.since_fit >= self.refit_every
+        if refit:
+            self.components = ica.fit_transform(data)
+            self.signs = [-1 if np.abs(np.max(c)) < np.abs(np.min(c)) else 1 for c in self.components.T]
+            self.since_fit = 0
+            changed = n
+        else:
+            changed = min(max(changed, shift), n)
+            self.components[:n - shift] = self.components[shift:]
+            self.components[n - changed:] = ica.transform(data[n - changed:])
+
+        separated = [sign * self.components[50:n - 50, k] for k, sign in enumerate(self.signs)]
+        for track, signal in zip(self.peaks, separated):
+            track.update(signal, start + 50, max(changed - 50, 0))
+        return separated, refit
+
+class ChannelTrack:
+    # What a sliding session carries for one channel besides its filters: the maternal peaks of get_hrlis,
+    # the QRS peaks split_qrs cuts around and, unless the ICA is shared, the components and which of them is fetal
+    __slots__ = ('maternal', 'qrs', 'components', 'fetal')
+
+    def __init__(self, components=True):
+        self.maternal = PeakTrack(0.4, 160)
+        self.qrs = PeakTrack()
+        self.components = ComponentTrack() if components else None
+        self.fetal = 0
+
+    def split(self, signal, start):
+        # split_qrs with the carried QRS peaks, and how many rows at the end of the window it changed:
+        # the QRS windows reach less than a refractory period before a peak that may have moved
+        self.qrs.update(signal, start)
+        changed = len(signal) - max(self.qrs.redo - self.qrs.refractory_period, 0)
+        return split_qrs(signal, self.qrs.window_peaks()), changed
+
 def get_hrlis_mat(signal, threshold_ratio, refractory_period):
     
     r_indices= adt_findrpeaks(signal, threshold_ratio = threshold_ratio, refractory_period=refractory_period)
@@ -416,76 +1134,146 @@ def missed_thresh(fhr_indices, fhr_signal, median):
     return fhr_indices_new, hr_bpm
 
 
+def qrs_windows(signal, indices, before, after):
+    # Windows [idx - before, idx + after) around every index, clipped to the signal.
+    # Returns the mask covered by all windows and the RMS of each window, both from one pass over the signal
+    n = len(signal)
+    indices = np.asarray(indices, dtype=int)
+    starts = np.maximum(indices - before, 0)
+    ends = np.minimum(indices + after, n)
+    lengths = ends - starts
+    valid = lengths > 0
+
+    # Window edges as +1/-1 steps, any sample with a positive running count is inside a window
+    edges = np.zeros(n + 1, dtype=int)
+    np.add.at(edges, starts[valid], 1)
+    np.add.at(edges, ends[valid], -1)
+    mask = np.cumsum(edges[:-1]) > 0
+
+    # Window sums of squares from the cumulative sum, empty windows give NaN like np.mean of an empty slice
+    squares = np.concatenate(([0.0], np.cumsum(np.square(signal, dtype=float))))
+    rms_values = np.full(len(indices), np.nan)
+    rms_values[valid] = np.sqrt((squares[ends[valid]] - squares[starts[valid]]) / lengths[valid])
+
+    return mask, rms_values.tolist()
+
 def peak_separation_ie(residual_signal, mhr_indices_adjusted):
-    main_ie = np.zeros(len(residual_signal))
     qrs_width = 30  # Adjust this value based on the width of the QRS complex
     alpha,beta = 1.6, 0.1   #1.2, 0.5
 
-    for idx in mhr_indices_adjusted:
-        if idx - int(alpha*qrs_width) >= 0 and idx + int(beta*qrs_width) < len(residual_signal):
-            main_ie[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)] = residual_signal[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)]
-        elif idx - int(alpha*qrs_width) < 0 :
-            main_ie[0: idx + int(beta*qrs_width)] = residual_signal[0: idx + int(beta*qrs_width)]
-        else:
-            main_ie[idx - int(alpha*qrs_width): len(residual_signal)] = residual_signal[idx - int(alpha*qrs_width): len(residual_signal)]
+    _, rms_values_ie = qrs_windows(residual_signal, mhr_indices_adjusted, int(alpha*qrs_width), int(beta*qrs_width))
 
-    rms_values_ie = []
+    return rms_values_ie  
 
-    for idx in mhr_indices_adjusted:
-        if idx - int(alpha*qrs_width) >= 0 and idx + int(beta*qrs_width) < len(residual_signal):
-            region = residual_signal[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)]
-        elif idx - int(alpha*qrs_width) < 0:
-            region = residual_signal[0: idx + int(beta*qrs_width)]
-        else:
-            region = residual_signal[idx - int(alpha*qrs_width): len(residual_signal)]
-        
-        rms = np.sqrt(np.mean(region**2))
-        rms_values_ie.append(rms)
 
-    return rms_values_ie  
 
 
+def condition_signal(signal, extra, filter_chain=None, lap=lambda name: None, scratch=None):
+    # Raw samples of one channel to the filtered ECG in mV: outlier removal, conversion and the filters.
+    # Without a filter_chain the previous 2000 samples in extra are filtered along and cut off again
+    # (a HistoryBuffer does the same without the concatenation). scratch holds the work arrays between batches
+    ecg_signal_noisy = signal
+    if filter_chain is None and isinstance(extra, HistoryBuffer):
+        ecg_signal_noisy = extra.push(ecg_signal_noisy)
+    elif filter_chain is None and len(extra)!=0:
+        ecg_signal_noisy = np.concatenate(( extra,ecg_signal_noisy), axis=0)
+
+    #Removing outliers
+    outliers = voltage = None
+    if scratch is not None:
+        outliers = scratch.get('outliers', ecg_signal_noisy.shape, ecg_signal_noisy.dtype)
+        voltage = scratch.get('voltage', ecg_signal_noisy.shape)
+    ecg_signal_noisy = remove_outliers(ecg_signal_noisy, out=outliers)
+    ecg_signal_noisy = quantized_value_to_voltage(ecg_signal_noisy, out=voltage)
+    lap('outliers')
+
+    if filter_chain is not None:
+        return filter_chain.filter(ecg_signal_noisy)
+
+    #select a portion of the stable part of the ecg
+    ecg_signal = ecg_signal_noisy
+    for b in fir_kernels():
+        ecg_signal, _ = fir_filter(b, ecg_signal)
+    from scipy.signal import lfilter
+    bank = get_filter_bank()
+    return lfilter(bank.b3, bank.a3, ecg_signal)[2000:]
+
+def split_qrs(signal, r_indices_ori=None):
+    # The maternal QRS complexes of a filtered channel (main) and what is left between them (residual),
+    # with the RMS of every QRS window. r_indices_ori are the QRS peaks if they are already known
+    if r_indices_ori is None:
+        r_indices_ori, integrated_signal, ht = adt_findrpeaks(signal)
 
+    # Extract the main ECG signal using QRS complex locations
+    qrs_width = 24  # Adjust this value based on the width of the QRS complex
+    alpha,beta = 0.65, 1.5
 
-def process_of_code(signal, extra, a, last_foetal, last_maternal):
-    # Extract the ECG signal columns
+    qrs_mask, rms_values_main = qrs_windows(signal, r_indices_ori, int(alpha*qrs_width), int(beta*qrs_width))
+    main_signal = np.where(qrs_mask, signal, 0.0)
 
-        
-        ecg_signal_noisy = signal
-       
-        if len(extra)!=0:
-            ecg_signal_noisy = np.concatenate(( extra,ecg_signal_noisy), axis=0)
-        # # Extract the Acoustic signal columns
-        # top_left = as1s
-        # top_right = as2s
-        # bottom_left = as3s
-        # bottom_right = as4s
-                
-        #Removing outliers
-      
-        try:
-            # print(ecg_signal_noisy[2000])
-            # print(ecg_signal_noisy[-1])
-            # print(len(ecg_signal_noisy))
-            ecg_signal_noisy = remove_outliers(ecg_signal_noisy)
-            ecg_signal_noisy = quantized_value_to_voltage(ecg_signal_noisy)
+    residual_signal = signal - main_signal
 
-            
-            #select a portion of the stable part of the ecg
-            ecg_signal = lfilter(b2,[1], lfilter(b1,[1],ecg_signal_noisy))
-            ecg_signal = lfilter(b3, a3, ecg_signal)[2000:]
+    # Interpolate zero values in residual_signal_1 using adjacent values from t_wave
+    residual_signal = fill_zero_runs(residual_signal)
 
-            signal = ecg_signal
-            
-            #print()
+    resnon_zero_elements = residual_signal[residual_signal != 0]
+    res_mean = np.mean(resnon_zero_elements)
+
+    main_signal[main_signal == 0] = res_mean
+    return main_signal, residual_signal, rms_values_main
+
+def channel_beats(fhr_indices, fhr_bpm, mhr_indices, f_signal, maternal_indices, residual_signal, a, timings=no_timings, lap=lambda name: None):
+    # The end of process_of_code once the fetal component is known: missed and low-threshold peak correction,
+    # beat times from the window start a, and the isoelectric RMS after every maternal peak.
+    # maternal_indices start with the peak before the window, like get_hrlis returns them
+    fhr_indices_new, fhr_bpm_new = missed_peaks(fhr_indices, fhr_bpm, mhr_indices)
+    median = np.median(fhr_bpm_new)
+
+    try:
+        fhr_indices_final, fhr_bpm_final = missed_thresh(fhr_indices_new, f_signal, median)
+    except IndexError as error:
+        fhr_indices_final = []
+        fhr_bpm_final = []
+        logger.warning("%s", error)
+        timings.count('errors')
+    finally:
+        lap('peak correction')
+    final_times = [round((x + a)*dt, 1) for x in fhr_indices_final]
+
+    # Maternal times skip the peak before the window and the first one in it
+    maternal_indices = maternal_indices[1:]
+    final_times_maternal = [round((x + a)*dt, 1) for x in maternal_indices[1:]]
+
+    rms_values_isoelectric = peak_separation_ie(residual_signal, [x + 140 for x in maternal_indices])
+    lap('isoelectric')
+
+    return final_times, fhr_bpm_final, fhr_indices_final, final_times_maternal, maternal_indices, rms_values_isoelectric
+
+def process_of_code(signal, extra, a, last_foetal, last_maternal, filter_chain=None, ica_stage=None, timings=no_timings, conditioned=False,
+                    scratch=None):
+    # Extract the ECG signal columns
+    # With a filter_chain the batch is filtered on its own and extra is not needed
+    # An ica_stage carries the unmixing matrix over from the previous batch of this channel
+    # timings receives the time spent in every stage
+    # conditioned means signal is already filtered (see condition_channels), scratch is passed on to condition_signal
+        lap = timings.lap_timer()
+
+
+        try:
+            if not conditioned:
+                signal = condition_signal(signal, extra, filter_chain, lap, scratch)
         except IndexError as e:
-            print(f"Index error: {e}")
+            logger.warning("Index error: %s", e)
+            timings.count('errors')
               
         except ValueError as e:
-            print(f"Value error: {e}")
+            logger.warning("Value error: %s", e)
+            timings.count('errors')
               
         finally:
-            pass
+            # A conditioned signal was filtered in condition_channels, which has its own 'filter' lap
+            if not conditioned:
+                lap('filter')
 
 
 
@@ -493,77 +1281,9 @@ def process_of_code(signal, extra, a, last_foetal, last_maternal):
       
         maternal_bpm,maternal_indices,_, _, _, _ ,end_maternal= get_hrlis(signal,last_maternal,threshold_ratio=0.4, refractory_period=160)
         # print(maternal_bpm)
-        r_indices_ori, integrated_signal, ht = adt_findrpeaks(signal)
-        # print(r_indices_ori)
-        
-        # maternal_bpm = [round(value) for value in maternal_bpm]
-
-        # get the maternal peaks and convert to bpm
-        delta_lis = []
-        dt = 1/fs
-        for i in range(1,(len(r_indices_ori))):
-            delta_lis.append(r_indices_ori[i] - r_indices_ori[i-1])
-
-        delta_t = [x*dt for x in delta_lis]
-        hr_bpm_maternal = [60/x for x in delta_t]
-        #print(hr_bpm_maternal)
-        maternal_mean = np.mean(np.array(hr_bpm_maternal))
-        maternal_std = np.std(np.array(hr_bpm_maternal))
-        
-       
-       # Extract the main ECG signal using QRS complex locations
-        main_signal = np.zeros(len(signal))
-        qrs_width = 24  # Adjust this value based on the width of the QRS complex
-        alpha,beta = 0.65, 1.5
-
-        for idx in r_indices_ori:
-            if idx - int(alpha*qrs_width) >= 0 and idx + int(beta*qrs_width) < len(signal):
-                main_signal[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)] = signal[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)]
-            elif idx - int(alpha*qrs_width) < 0 :
-                main_signal[0: idx + int(beta*qrs_width)] = signal[0: idx + int(beta*qrs_width)]
-            else:
-                main_signal[idx - int(alpha*qrs_width): len(signal)] = signal[idx - int(alpha*qrs_width): len(signal)]
-
-
-        rms_values_main = []
-
-        for idx in r_indices_ori:
-            if idx - int(alpha*qrs_width) >= 0 and idx + int(beta*qrs_width) < len(signal):
-                region_m = signal[idx - int(alpha*qrs_width): idx + int(beta*qrs_width)]
-            elif idx - int(alpha*qrs_width) < 0:
-                region_m = signal[0: idx + int(beta*qrs_width)]
-            else:
-                region_m = signal[idx - int(alpha*qrs_width): len(signal)]
-            
-            rms_main = np.sqrt(np.mean(region_m**2))
-            rms_values_main.append(rms_main)
-        
-        residual_signal = signal - main_signal
-
-        # Interpolate zero values in residual_signal_1 using adjacent values from t_wave
-        zero_indices = np.where(residual_signal == 0)[0]  # Find indices where residual_signal_1 is zero
-
-        for idx in zero_indices:
-            left_idx = idx - 1
-            right_idx = idx + 1
-
-            # Find nearest non-zero values in t_wave for interpolation
-            while left_idx >= 0 and residual_signal[left_idx] == 0:
-                left_idx -= 1
-            while right_idx < len(residual_signal) and residual_signal[right_idx] == 0:
-                right_idx += 1
-
-            # Check bounds and interpolate using numpy.interp
-            if left_idx >= 0 and right_idx < len(residual_signal):
-                residual_signal[idx] = np.interp(idx, [left_idx, right_idx], [residual_signal[left_idx], residual_signal[right_idx]])
+        lap('rpeaks')
 
-        residual_with_zeros = np.copy(residual_signal)
-        main_with_zeros = np.copy(main_signal)
-
-        resnon_zero_elements = residual_signal[residual_signal != 0]
-        res_mean = np.mean(resnon_zero_elements)
-
-        main_signal[main_signal == 0] = res_mean
+        main_signal, residual_signal, rms_values_main = split_qrs(signal)
         
 
         # De-average and whiten the data
@@ -577,22 +1297,13 @@ def process_of_code(signal, extra, a, last_foetal, last_maternal):
         # three signals from 2 sources
         data = np.vstack((signal_1, signal_2, signal_3))
 
-        data_mean = np.mean(data, axis=1)
-        data_centered = data - data_mean[:, np.newaxis]
-
-       
-
-        # Calculate the covariance matrix and perform eigenvalue decomposition
-        cov_matrix = np.cov(data_centered)
-        eigenvalues, eigenvectors = np.linalg.eigh(cov_matrix)
-
         # Apply ICA to separate the main signal from the residual
-        # Whiteing is done via the function itself
-        ica = FastICA(n_components=2, whiten = "arbitrary-variance", whiten_solver="eigh")
-        ica.fit(data.T)
-
-        # Get the independent components
-        independent_components = ica.transform(data.T)
+        # Whitening, fit and the independent components come from a single fit_transform
+        if ica_stage is None:
+            ica_stage = IcaStage(warm_start=False)
+        lap('qrs windows')
+        independent_components = ica_stage.fit_transform(data.T)
+        lap('ica')
 
         # Separate the main signal and the residual using the independent components
         # separated_signal_1_original = independent_components[:, 0]#[200:]
@@ -616,14 +1327,17 @@ def process_of_code(signal, extra, a, last_foetal, last_maternal):
        
         hr_bpm_1,r_indices_1,hr_mean1, hr_std1, hr_bpm_new_1, integrated_1,end_pos_1  = get_hrlis(separated_signal_1,last_foetal,threshold_ratio=0.4, refractory_period=160)
         r_indices_1 = [x+18 for x in r_indices_1]
-        ent1 = ent.sample_entropy(separated_signal_1, 1)
-        # print("Sample entropy = ", ent.sample_entropy(separated_signal_1, 1))
         
 
         hr_bpm_2, r_indices_2, hr_mean2, hr_std2, hr_bpm_new_2, integrated_2,end_pos_2  = get_hrlis(separated_signal_2,last_foetal, threshold_ratio=0.4, refractory_period=160)
         r_indices_2 = [x+18 for x in r_indices_2]
-        ent2 = ent.sample_entropy(separated_signal_2, 1) 
-        # print("Sample entropy = ", ent.sample_entropy(separated_signal_2, 1))
+        lap('component peaks')
+
+        ent1 = component_irregularity(separated_signal_1)
+        # print("Sample entropy = ", sample_entropy(separated_signal_1, 1))
+        ent2 = component_irregularity(separated_signal_2) 
+        # print("Sample entropy = ", sample_entropy(separated_signal_2, 1))
+        lap('entropy')
         
 
 
@@ -651,28 +1365,8 @@ def process_of_code(signal, extra, a, last_foetal, last_maternal):
                 
         
           
-        fhr_indices_new, fhr_bpm_new = missed_peaks(fhr_indices, fhr_bpm, mhr_indices)
-        median = np.median(fhr_bpm_new) 
-        
-        
-        try:
-            fhr_indices_final, fhr_bpm_final = missed_thresh(fhr_indices_new, f_signal, median)
-        except IndexError as error:
-            fhr_indices_final=[]
-            fhr_bpm_final=[]
-            print(error)
-        finally:
-            pass    
-        fhr_indices_vals =[x + a  for x in fhr_indices_final[0:]]
-        final_times = [round(x*dt, 1) for x in fhr_indices_vals]
-
-        maternal_indices = maternal_indices[1:]
-        #Change the maternal Indices
-        maternal_indices_vals = [x + a  for x in maternal_indices[1:]]
-        final_times_maternal  = [round(x*dt, 1) for x in maternal_indices_vals]
-
-        mhr_indices_adjusted = [x + 140 for x in maternal_indices]
-        rms_values_isoelectric = peak_separation_ie(residual_signal, mhr_indices_adjusted)       
+        final_times, fhr_bpm_final, fhr_indices_final, final_times_maternal, maternal_indices, rms_values_isoelectric = \
+            channel_beats(fhr_indices, fhr_bpm, mhr_indices, f_signal, maternal_indices, residual_signal, a, timings, lap)
 
         # print("Final times fhr: ",len(final_times), final_times)
         # print("Final bpm:       ",len(fhr_bpm_final), fhr_bpm_final)
@@ -699,23 +1393,615 @@ def process_of_code(signal, extra, a, last_foetal, last_maternal):
         #boink(temp_ar)
 
 
-
-def main():
-    columns = ['A','B','C','D']
-    file_path = 'data/2025-02-28/21_ECG_WCTG.csv'
-    df = pd.read_csv(file_path, header=None, names=columns)
-
-    last_foetal_B = 0
-    last_maternal_B = 0
-
-    last_foetal_D = 0
-    last_maternal_D = 0
-
-    last_foetal_A = 0
-    last_maternal_A = 0
-
-    last_foetal_C = 0
-    last_maternal_C = 0
+def process_window(signal, state, a, timings=no_timings, conditioned=False):
+    # process_of_code for one channel of a sliding session, returning the same tuple. The peaks, the ICA fit
+    # and the choice of the fetal component are carried in state.track from one window to the next,
+    # so only the samples that changed are searched again and the ICA is fit once every sliding_refit samples
+    lap = timings.lap_timer()
+    track = state.track
+    if not conditioned:
+        signal = condition_signal(signal, state.extra, state.chain, lap, state.scratch)
+        lap('filter')
+
+    maternal_bpm, maternal_indices, end_maternal = track.maternal.hrlis(signal, a)
+    lap('rpeaks')
+
+    (main_signal, residual_signal, rms_values_main), changed = track.split(signal, a)
+    lap('qrs windows')
+
+    separated, refit = track.components.update(state.ica, np.column_stack((main_signal, residual_signal, signal)), a, changed)
+    lap('ica')
+
+    rates = []
+    for peaks in track.components.peaks:
+        hr_bpm, r_indices, end_pos = peaks.rates()
+        rates.append((hr_bpm, [x+18 for x in r_indices], end_pos))
+    lap('component peaks')
+
+    if refit:
+        # Perform function on the signal with maximum entropy, until the next fit
+        track.fetal = 0 if component_irregularity(separated[0]) > component_irregularity(separated[1]) else 1
+        lap('entropy')
+
+    fhr_bpm, fhr_indices, end_pos = rates[track.fetal]
+    mhr_indices = rates[1 - track.fetal][1]
+    final_times, fhr_bpm_final, fhr_indices_final, final_times_maternal, maternal_indices, rms_values_isoelectric = \
+        channel_beats(fhr_indices, fhr_bpm, mhr_indices, separated[track.fetal], maternal_indices, residual_signal, a, timings, lap)
+    return (final_times, fhr_bpm_final, fhr_indices_final, final_times_maternal, maternal_bpm, maternal_indices, end_pos, end_maternal,
+            rms_values_main, rms_values_isoelectric)
+
+def make_channel_executor(mode=channel_mode, workers=channel_workers):
+    # The channels share no state, so they can run side by side in a pool
+    if mode == "process":
+        # Bring the .npz up to date here, so the workers only load it instead of all rebuilding it at once
+        get_filter_bank()
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    if mode == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    if mode == "serial":
+        return None
+    raise ValueError(f"Unknown channel mode: {mode}")
+
+class ChannelResult:
+    # The beats one channel found in one batch, as returned by process_of_code: foetal and maternal beat
+    # times, rates and sample indices, the last foetal/maternal peak and the per-beat QRS/isoelectric RMS
+    __slots__ = ('fhr_times', 'fhr', 'fhr_indices', 'mhr_times', 'mhr', 'mhr_indices',
+                 'end_foetal', 'end_maternal', 'rms_main', 'rms_iso')
+
+    def __init__(self, fhr_times, fhr, fhr_indices, mhr_times, mhr, mhr_indices, end_foetal, end_maternal, rms_main, rms_iso):
+        self.fhr_times = fhr_times
+        self.fhr = fhr
+        self.fhr_indices = fhr_indices
+        self.mhr_times = mhr_times
+        self.mhr = mhr
+        self.mhr_indices = mhr_indices
+        self.end_foetal = end_foetal
+        self.end_maternal = end_maternal
+        self.rms_main = rms_main
+        self.rms_iso = rms_iso
+
+    @property
+    def ratio(self):
+        return rms_ratio(self.rms_main, self.rms_iso)
+
+def process_channel(signal, state, a, timed=False, conditioned=False):
+    # A worker process updates a copy of the ChannelState, so hand the new state back to the caller,
+    # together with the worker's timings when timed
+    timings = StageTimings() if timed else no_timings
+    started = time.perf_counter()
+    if state.track is not None:
+        result = ChannelResult(*process_window(signal, state, a, timings, conditioned))
+    else:
+        result = ChannelResult(*process_of_code(signal, state.extra, a, state.last_foetal, state.last_maternal, state.chain, state.ica,
+                                                timings, conditioned, state.scratch))
+    timings.add('channel', time.perf_counter() - started)
+    return result, state, timings
+
+def run_channels(executor, jobs):
+    # jobs holds one process_channel argument tuple per channel, results come back in the same order
+    if executor is None:
+        return [process_channel(*job) for job in jobs]
+
+    futures = [executor.submit(process_channel, *job) for job in jobs]
+    return [future.result() for future in futures]
+
+
+def iter_csv_batches(file_path, batch_size=3000, columns=channel_names):
+    # Read the recording batch_size rows at a time as (rows, channels) int32 arrays, so memory stays
+    # bounded and the first batch can be processed before the rest of the file is parsed
+    import pandas as pd
+    with pd.read_csv(file_path, header=None, names=list(columns), dtype=np.int32, chunksize=batch_size) as reader:
+        for batch_df in reader:
+            yield batch_df.to_numpy()
+
+def write_recording_header(file, channels, sample_rate=fs, bit_depth=24):
+    # Header is padded to a multiple of 64 bytes so the samples start aligned
+    names = b''.join(name.encode('ascii')[:recording_name_size].ljust(recording_name_size, b'\0') for name in channels)
+    header_size = -(-(recording_header.size + len(names)) // 64) * 64
+    header = recording_header.pack(recording_magic, header_size, sample_rate, bit_depth, len(channels)) + names
+    file.write(header.ljust(header_size, b'\0'))
+
+def read_recording_header(file):
+    magic, header_size, sample_rate, bit_depth, n_channels = recording_header.unpack(file.read(recording_header.size))
+    if magic != recording_magic:
+        raise ValueError(f"Not a binary ECG recording: {file.name}")
+    names = file.read(n_channels * recording_name_size)
+    channels = [names[i:i + recording_name_size].rstrip(b'\0').decode('ascii') for i in range(0, len(names), recording_name_size)]
+    return {'fs': sample_rate, 'bit_depth': bit_depth, 'channels': channels, 'header_size': header_size}
+
+def convert_csv_to_recording(csv_path, out_path=None, columns=channel_names, bit_depth=24):
+    # Stream a CSV dump into the binary format, one block at a time
+    if out_path is None:
+        out_path = os.path.splitext(csv_path)[0] + recording_extension
+
+    with open(out_path, 'wb') as file:
+        write_recording_header(file, columns, fs, bit_depth)
+        for block in iter_csv_batches(csv_path, 100000, columns):
+            file.write(block.astype('<i4').tobytes())
+
+    return out_path
+
+def open_recording(path):
+    # Memory-map the samples as an (n_samples, n_channels) int32 array, nothing is read until it is used
+    with open(path, 'rb') as file:
+        info = read_recording_header(file)
+
+    n_channels = len(info['channels'])
+    n_samples = (os.path.getsize(path) - info['header_size']) // (4 * n_channels)
+    samples = np.memmap(path, dtype='<i4', mode='r', offset=info['header_size'], shape=(n_samples, n_channels))
+    return samples, info
+
+def recording_columns(info, path, columns=channel_names):
+    # Where each of columns is stored in the recording. The pipeline assumes fs and 24-bit samples,
+    # so a recording made at another rate or bit depth is refused rather than silently misread
+    if info['fs'] != fs:
+        raise ValueError(f"{path}: sampled at {info['fs']} Hz, expected {fs} Hz")
+    if info['bit_depth'] != 24:
+        raise ValueError(f"{path}: {info['bit_depth']}-bit samples, expected 24-bit")
+    missing = [channel for channel in columns if channel not in info['channels']]
+    if missing:
+        raise ValueError(f"{path}: no channel {', '.join(missing)} in {info['channels']}")
+    return [info['channels'].index(channel) for channel in columns]
+
+def iter_recording_batches(path, batch_size=3000, columns=channel_names):
+    # Batches are views of the memory map, no samples are copied unless the recording stores
+    # its channels in another order than columns
+    samples, info = open_recording(path)
+    index = recording_columns(info, path, columns)
+    in_order = index == list(range(samples.shape[1]))
+    for start in range(0, len(samples), batch_size):
+        batch = samples[start:start + batch_size]
+        yield batch if in_order else batch[:, index]
+
+def iter_batches(file_path, batch_size=3000, columns=channel_names):
+    if file_path.endswith(recording_extension):
+        return iter_recording_batches(file_path, batch_size, columns)
+    return iter_csv_batches(file_path, batch_size, columns)
+
+
+class ChannelState:
+    # What one channel carries from one batch to the next: the raw history for the non-streaming filters,
+    # the last foetal/maternal peaks, the filter chain, the ICA stage, the work arrays of condition_signal
+    # and, in a sliding session, the ChannelTrack of the window
+    __slots__ = ('extra', 'last_foetal', 'last_maternal', 'chain', 'ica', 'scratch', 'track')
+
+    def __init__(self, chain=None, ica=None, track=None):
+        self.extra = HistoryBuffer(2000)
+        self.last_foetal = 0
+        self.last_maternal = 0
+        self.chain = chain
+        self.ica = ica
+        self.scratch = ScratchArrays()
+        self.track = track
+
+def new_session(streaming=streaming_filters, warm_start=ica_warm_start, sliding=False, separation=separation_mode,
+                stacked=stacked_filters):
+    # Per-channel state carried from one batch to the next. A sliding session keeps the filtered
+    # window and the ChannelTrack of every channel and takes hops of new rows instead of whole batches.
+    # A multichannel session also holds the shared ICA under 'multichannel'. A stacked session
+    # filters all channels with the one chain under 'filters' instead of one chain per channel
+    if separation not in ("channel", "multichannel"):
+        raise ValueError(f"Unknown separation mode: {separation}")
+    stacked = stacked and (streaming or sliding)
+
+    def chain():
+        if sliding:
+            return SlidingWindow()
+        return StreamingFilterChain() if streaming else None
+
+    def ica(n_components=2):
+        return IcaStage(warm_start=warm_start, n_components=n_components)
+
+    # With a shared ICA the channels only track their own peaks
+    multichannel = separation == "multichannel"
+    session = {channel: ChannelState(None if stacked else chain(), ica(), ChannelTrack(not multichannel) if sliding else None)
+               for channel in channel_names}
+    session['filters'] = chain() if stacked else None
+    session['raw'] = RawWindow() if sliding else None
+    session['scratch'] = ScratchArrays()
+    session['multichannel'] = None
+    if multichannel:
+        session['multichannel'] = {'ica': ica(len(channel_names)), 'last_foetal': 0,
+                                   'components': ComponentTrack(len(channel_names)) if sliding else None, 'roles': None}
+    return session
+
+def is_sliding(session):
+    return session['raw'] is not None
+
+def reject_artifacts(batch, session):
+    # clean_invalid_block_array for a batch. A sliding session cleans its whole raw window
+    # and returns only the rows of the batch, the rest of the window is already filtered
+    if not is_sliding(session):
+        return clean_invalid_block_array(batch)
+    cleaned, invalid_indexes = clean_invalid_block_array(session['raw'].push(batch))
+    first = len(cleaned) - len(batch)
+    return cleaned[first:], invalid_indexes[invalid_indexes >= first] - first
+
+def condition_channels(cleaned, session, lap=lambda name: None, timings=no_timings):
+    # The filtered (channels, samples) stack of a stacked session, with one call per filter stage for all channels.
+    # Like process_of_code, the raw samples go on if conditioning fails
+    try:
+        return condition_signal(cleaned.T, [], session['filters'], lap, session['scratch'])
+    except (IndexError, ValueError) as e:
+        logger.warning("%s: %s", type(e).__name__, e)
+        timings.count('errors')
+        return cleaned.T.astype(float)
+    finally:
+        lap('filter')
+
+def channel_job(signal, state, start_index, timed=False, conditioned=False):
+    # process_channel arguments for one channel of the session
+    return (signal, state, start_index, timed, conditioned)
+
+def analyse_batch(batch, start_index, session, executor=None, timings=no_timings):
+    # Artifact rejection, the four channels and the best-sensor selection for one
+    # (3000, channels) batch. Returns None if the batch is too short to process.
+    # In a sliding session batch holds only the new rows and start_index is where the window starts
+    if session['multichannel'] is not None:
+        return analyse_multichannel(batch, start_index, session, timings)
+
+    lap = timings.lap_timer()
+    cleaned, invalid_indexes = reject_artifacts(batch, session)
+    lap('artifacts')
+
+    sliding = is_sliding(session)
+    if len(cleaned) < 3000 and not sliding:
+        return None
+
+    # A stacked session hands the channels over filtered, and keeps the filter state here
+    stacked = session['filters'] is not None
+    signals = condition_channels(cleaned, session, lap, timings) if stacked else cleaned.T
+    columns = {channel: signals[i] for i, channel in enumerate(channel_names)}
+
+    order = ordered_channels(channel_order)
+    outputs = run_channels(executor, [channel_job(columns[channel], session[channel], start_index, timings.enabled, stacked) for channel in order])
+    lap('channels')
+
+    results = {}
+    for channel, (result, state, channel_timings) in zip(order, outputs):
+        results[channel] = result
+        timings.merge(channel_timings, prefix=f"{channel} ")
+        timings.count(f"{channel} fhr beats", len(result.fhr_times))
+        timings.count(f"{channel} mhr beats", len(result.mhr_times))
+
+        # Carry the channel state over to the next batch (process workers send back an updated copy)
+        session[channel] = state
+        # The next batch starts its first beat interval from the last peak of this one. A sliding
+        # session keeps the peak before the window in its ChannelTrack instead
+        if not sliding:
+            state.last_foetal = result.end_foetal
+            state.last_maternal = result.end_maternal
+
+    # FHR, MHR and the best sensor all go to the channel that found the most foetal beats
+    counts = {channel: len(result.fhr_times) for channel, result in results.items()}
+    foetal = results[most_beats(counts, fhr_precedence)]
+    maternal = results[most_beats(counts, mhr_precedence)]
+    best = most_beats(counts, best_ecg_precedence)
+    best_ECG = sensor_names.get(best, best) if any(counts.values()) else None
+
+    final_fhr = foetal.fhr
+    smooth_bpm(final_fhr)
+
+    ##Adding for new laptop with new version
+
+    final_time_fhr = [float(x) for x in foetal.fhr_times]
+
+    ratios = {channel: results[channel].ratio for channel in order}
+    lap('selection')
+
+    return {'best_ECG': best_ECG,
+            'ratios': ratios,
+            'final_time_fhr': final_time_fhr,
+            'final_fhr': final_fhr,
+            'final_time_mhr': maternal.mhr_times,
+            'final_mhr': maternal.mhr}
+
+def smooth_bpm(bpm):
+    # Average every value with the already smoothed one before it, in place
+    for i in range(1, len(bpm)):
+        bpm[i] = int((bpm[i-1]+bpm[i])/2)
+
+def ordered_channels(preferred):
+    # channel_names with the ones in preferred first, in that order
+    return [channel for channel in preferred if channel in channel_names] + [channel for channel in channel_names if channel not in preferred]
+
+def most_beats(counts, precedence):
+    # The channel with the highest count, ties going to the one that comes first in precedence
+    return max(ordered_channels(precedence), key=counts.get)
+
+def rms_ratio(rms_main, rms_iso):
+    # Mean QRS RMS over mean isoelectric RMS, each without its 2 highest and 2 lowest values
+    return np.mean(sorted(rms_main)[2:-2]) / np.mean(sorted(rms_iso)[2:-2])
+
+def analyse_multichannel(batch, start_index, session, timings=no_timings):
+    # One ICA of all electrodes stacked together (with their main/residual signals if multichannel_derived)
+    # instead of one per electrode. The components are told apart by sample entropy and heart rate, and
+    # best_ECG is the electrode that follows the fetal component most closely. Returns the same dict as analyse_batch
+    lap = timings.lap_timer()
+    cleaned, invalid_indexes = reject_artifacts(batch, session)
+    lap('artifacts')
+
+    sliding = is_sliding(session)
+    if len(cleaned) < 3000 and not sliding:
+        return None
+
+    shared = session['multichannel']
+    stacked = session['filters'] is not None
+    if stacked:
+        stack = condition_channels(cleaned, session, lap, timings)
+
+    signals = {}
+    maternal = {}
+    ratios = {}
+    inputs = []
+    changed = 0
+    for i, channel in enumerate(channel_names):
+        state = session[channel]
+        if stacked:
+            signal = stack[i]
+        else:
+            signal = cleaned[:, i]
+            try:
+                signal = condition_signal(signal, state.extra, state.chain, scratch=state.scratch)
+            except (IndexError, ValueError) as e:
+                logger.warning("%s: %s", type(e).__name__, e)
+                timings.count(f"{channel} errors")
+            lap('filter')
+
+        if state.track is None:
+            main_signal, residual_signal, rms_main = split_qrs(signal)
+            maternal_bpm, maternal_indices, _, _, _, _, end_maternal = get_hrlis(signal, state.last_maternal, threshold_ratio=0.4, refractory_period=160)
+        else:
+            # The derived inputs change as far back as the QRS peaks could move
+            (main_signal, residual_signal, rms_main), rows = state.track.split(signal, start_index)
+            if multichannel_derived:
+                changed = max(changed, rows)
+            maternal_bpm, maternal_indices, end_maternal = state.track.maternal.hrlis(signal, start_index)
+        maternal_indices = maternal_indices[1:]
+        rms_iso = peak_separation_ie(residual_signal, [x + 140 for x in maternal_indices])
+        if not sliding:
+            state.last_maternal = end_maternal
+
+        signals[channel] = signal
+        maternal[channel] = ([round((x + start_index)*dt, 1) for x in maternal_indices[1:]], maternal_bpm)
+        ratios[channel] = rms_ratio(rms_main, rms_iso)
+        inputs.extend([signal, main_signal, residual_signal] if multichannel_derived else [signal])
+        lap('maternal peaks')
+
+    track = shared['components']
+    candidates = []
+    if track is None:
+        components = shared['ica'].fit_transform(np.column_stack(inputs))
+        refit = True
+        lap('ica')
+        for k in range(components.shape[1]):
+            separated = correct_sign(components[:, k])[50:2950]
+            hr_bpm, r_indices, _, _, _, _, end_pos = get_hrlis(separated, shared['last_foetal'], threshold_ratio=0.4, refractory_period=160)
+            candidates.append((separated, hr_bpm, [x+18 for x in r_indices], end_pos))
+    else:
+        # A sliding session fits the ICA once every sliding_refit samples and carries the component peaks
+        components, refit = track.update(shared['ica'], np.column_stack(inputs), start_index, changed)
+        lap('ica')
+        for separated, peaks in zip(components, track.peaks):
+            hr_bpm, r_indices, end_pos = peaks.rates()
+            candidates.append((separated, hr_bpm, [x+18 for x in r_indices], end_pos))
+    lap('component peaks')
+
+    if refit:
+        # The maternal ECG is the most regular component. Of the others, the noise components are the most
+        # irregular, so the fetal one is the most regular of those left with a fetal heart rate.
+        # A sliding session keeps these roles until the next fit
+        irregularity = [np.ravel(component_irregularity(separated))[0] for separated, _, _, _ in candidates]
+        mother = int(np.argmin(irregularity))
+        others = [k for k in range(len(candidates)) if k != mother]
+        plausible = [k for k in others if len(candidates[k][1]) and 110 <= np.median(candidates[k][1]) <= 180]
+        fetal = min(plausible, key=lambda k: irregularity[k]) if plausible else None
+        shared['roles'] = (mother, fetal)
+        lap('entropy')
+    mother, fetal = shared['roles']
+
+    if fetal is not None:
+        f_signal, fhr_bpm, fhr_indices, end_pos = candidates[fetal]
+        fhr_indices_new, fhr_bpm_new = missed_peaks(fhr_indices, fhr_bpm, candidates[mother][2])
+        try:
+            fhr_indices_final, fhr_bpm_final = missed_thresh(fhr_indices_new, f_signal, np.median(fhr_bpm_new))
+        except IndexError as error:
+            fhr_indices_final = []
+            fhr_bpm_final = []
+            logger.warning("%s", error)
+        reference = f_signal
+    else:
+        # Any other pick would be a guess, so the batch has no FHR and no best sensor.
+        # The maternal beats come from the electrode that follows the maternal component most closely
+        logger.warning("No fetal component in the batch starting at sample %d", start_index)
+        timings.count('no fetal component')
+        fhr_indices_final = []
+        fhr_bpm_final = []
+        end_pos = 0
+        reference = candidates[mother][0]
+    if not sliding:
+        shared['last_foetal'] = end_pos
+    lap('peak correction')
+
+    similarity = {channel: abs(np.corrcoef(signals[channel][50:2950], reference)[0, 1]) for channel in channel_names}
+    best = max(channel_names, key=similarity.get)
+    smooth_bpm(fhr_bpm_final)
+    lap('selection')
+
+    return {'best_ECG': sensor_names.get(best, best) if fetal is not None else None,
+            'ratios': ratios,
+            'final_time_fhr': [float(round((x + start_index)*dt, 1)) for x in fhr_indices_final],
+            'final_fhr': fhr_bpm_final,
+            'final_time_mhr': maternal[best][0],
+            'final_mhr': maternal[best][1]}
+
+def check_hop(hop, window_size=3000):
+    if hop is not None and not 0 < hop <= window_size:
+        raise ValueError(f"hop must be between 1 and {window_size} samples, got {hop}")
+
+def iter_hops(blocks, hop, window_size=3000):
+    # Regroup (n_rows, channels) blocks of any size into one full window followed by steps of hop rows
+    pending = []
+    n_pending = 0
+    size = window_size
+    for block in blocks:
+        pending.append(block)
+        n_pending += len(block)
+        while n_pending >= size:
+            rows = np.concatenate(pending)
+            yield rows[:size]
+            pending = [rows[size:]]
+            n_pending -= size
+            size = hop
+
+def take_new_beats(result, last_reported, min_gap=160 * dt):
+    # Overlapping windows find the same beats again, a sample or two apart. Keep only the beats that are
+    # more than a refractory period after the last reported one, last_reported holds that time for 'fhr' and 'mhr'
+    new = dict(result)
+    for kind, times_key, bpm_key in (('fhr', 'final_time_fhr', 'final_fhr'), ('mhr', 'final_time_mhr', 'final_mhr')):
+        beats = [(t, bpm) for t, bpm in zip(result[times_key], result[bpm_key]) if t > last_reported[kind] + min_gap]
+        new[times_key] = [t for t, _ in beats]
+        new[bpm_key] = [bpm for _, bpm in beats]
+        if beats:
+            last_reported[kind] = beats[-1][0]
+    return new
+
+def print_batch_header(batch_num):
+    logger.info("##################################################################\n")
+    logger.info("Time slots %s", batch_num)
+
+def sensor_ratios(result):
+    # (sensor name in lower case, ratio) for every channel of a batch result, in channel_order
+    return [(sensor_names.get(channel, channel).lower(), result['ratios'][channel]) for channel in ordered_channels(channel_order)]
+
+def report_batch(batch_num, result, sink):
+    # The whole lists are only formatted when they are going to be shown
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("\n".join([
+            *(f"Ratio {sensor + ' sensor':<13} = {ratio}" for sensor, ratio in sensor_ratios(result)),
+            "",
+            f"Best ECG: {result['best_ECG']}",
+            "",
+            f"Final_Time_FHR: {result['final_time_fhr']}",
+            f"Final_FHR: {result['final_fhr']}",
+            "",
+            f"Final_Time_MHR: {result['final_time_mhr']}",
+            f"Final_MHR: {result['final_mhr']}",
+        ]))
+
+    sink.write(batch_num, result)
+
+class ResultsSink:
+    # Keeps the results file open for the whole run and buffers the writes.
+    # The format follows the extension: .jsonl is one object per batch, .csv one row per
+    # FHR/MHR beat with the batch's best sensor and ratios (a batch without beats gets one row with empty beat
+    # fields, so its sensor and ratios are not lost), anything else the text report
+    csv_columns = ['batch', 'kind', 'time', 'bpm', 'best_ecg'] + [f'ratio_{channel}' for channel in channel_names]
+
+    def __init__(self, path, fmt=None, buffer_size=1 << 16):
+        if fmt is None:
+            fmt = {'.jsonl': 'jsonl', '.csv': 'csv'}.get(os.path.splitext(path)[1].lower(), 'text')
+        if fmt not in ('text', 'jsonl', 'csv'):
+            raise ValueError(f"Unknown results format: {fmt}")
+
+        self.fmt = fmt
+        self.file = open(path, "a", buffering=buffer_size, newline='' if fmt == 'csv' else None)
+        if fmt == 'csv':
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(self.csv_columns)
+
+    def write(self, batch_num, result):
+        if self.fmt == 'jsonl':
+            self.write_jsonl(batch_num, result)
+        elif self.fmt == 'csv':
+            self.write_csv(batch_num, result)
+        else:
+            self.write_text(batch_num, result)
+
+    def write_text(self, batch_num, result):
+        ratios = "".join(f"Ratio {sensor:<6} sensor = {round(ratio, 2)}\n" for sensor, ratio in sensor_ratios(result))
+        self.file.write(f"##################################################################\n"
+                        f"\n"
+                        f"Time slots {batch_num}\n"
+                        f"Best ECG: {result['best_ECG']}\n"
+                        f"\n"
+                        f"{ratios}"
+                        f"\n"
+                        f"Final_Time_FHR: {result['final_time_fhr']}\n"
+                        f"Final_FHR: {result['final_fhr']}\n"
+                        f"\n"
+                        f"Final_Time_MHR: {result['final_time_mhr']}\n"
+                        f"Final_MHR: {result['final_mhr']}\n"
+                        f"\n")
+
+    def write_jsonl(self, batch_num, result):
+        record = {'batch': batch_num,
+                  'best_ecg': result['best_ECG'],
+                  'ratios': {channel: json_number(ratio) for channel, ratio in result['ratios'].items()},
+                  'fhr_time': [json_number(x) for x in result['final_time_fhr']],
+                  'fhr': [json_number(x) for x in result['final_fhr']],
+                  'mhr_time': [json_number(x) for x in result['final_time_mhr']],
+                  'mhr': [json_number(x) for x in result['final_mhr']]}
+        self.file.write(json.dumps(record) + "\n")
+
+    def write_csv(self, batch_num, result):
+        ratios = [json_number(result['ratios'][channel]) for channel in channel_names]
+        rows = [[batch_num, kind, json_number(t), json_number(b), result['best_ECG']] + ratios
+                for kind, times, bpm in (('fhr', result['final_time_fhr'], result['final_fhr']),
+                                         ('mhr', result['final_time_mhr'], result['final_mhr']))
+                for t, b in zip(times, bpm)]
+        self.writer.writerows(rows or [[batch_num, '', '', '', result['best_ECG']] + ratios])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def json_number(value):
+    # Plain Python number for the writers, NaN/inf (e.g. a ratio with no beats) become None
+    value = value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+def print_totals(total_time_var, total_fhr_var, total_mhr_time, toatl_mhr):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info("\n".join([
+        "",
+        f"Total_FHR_points=  {len(total_time_var)}",
+        f"Total_FHR = {total_fhr_var}",
+        "",
+        f"Total_FHR_Time = {total_time_var}",
+        "",
+        f"Total_MHR_points=  {len(total_mhr_time)}",
+        f"Total_MHR={toatl_mhr}",
+        "",
+        f"Total_MHR_Time={total_mhr_time}",
+    ]))
+
+
+def main(mode=channel_mode, streaming=streaming_filters, warm_start=ica_warm_start, file_path='data/2025-02-28/21_ECG_WCTG.csv',
+         results_file="ICA for ALL sensors  2025-02-28- ECG_21 bilinear 2 _60Hz.txt", timed=collect_timings, profiler=None,
+         hop=sliding_hop, separation=separation_mode):
+    # profiler is started and stopped around every batch, see BatchProfiler.
+    # With a hop every batch is a sliding window that only reports the beats it found first.
+    # Returns False if the run stopped on an error or an interrupt, True otherwise
+    check_hop(hop)
+    if hop:
+        batches = iter_hops(iter_batches(file_path, hop), hop)
+    else:
+        batches = iter_batches(file_path, 3000)
+    samples_seen = 0
+    last_reported = {'fhr': -math.inf, 'mhr': -math.inf}
 
     total_FHR_points = 0
     total_MHR_points = 0
@@ -727,221 +2013,46 @@ def main():
     toatl_mhr = []
     total_mhr_time=[]
 
-    extra_A,extra_B,extra_C,extra_D = [],[],[],[]
-    final_time_fhr,final_fhr,final_time_mhr,final_mhr = [],[],[],[]
-
-    best_ECG = None
-    extra=[]
+    session = new_session(streaming, warm_start, sliding=bool(hop), separation=separation)
+    # The multichannel ICA runs in this process, a channel pool would only be started and shut down
+    executor = make_channel_executor(mode) if separation == "channel" else None
+    sink = ResultsSink(results_file)
+    timings = StageTimings() if timed else no_timings
 
     try:
         while True:
                 # Process data in batches of 3000 samples
-                start_index = (batch_num - 1) * 3000
-                end_index = batch_num * 3000
-                batch_df = df[start_index:end_index]
-
-
-                print("##################################################################\n")
-                print(f'Time slots {batch_num}')
-
-            # if (batch_num%10==1 or best_ECG==None ):
-               
-                column_D = batch_df['D']
-                column_B = batch_df['B']
-                column_C = batch_df['C']
-                column_A = batch_df['A']
-
-                # Calculate thresholds for each column
-                threshold_A = calculate_threshold(column_A)
-                threshold_B = calculate_threshold(column_B)
-                threshold_C = calculate_threshold(column_C)
-                threshold_D = calculate_threshold(column_D)
-
-                cleaned_df ,invalid_indexes= clean_invalid_blocks(batch_df, threshold_A ,threshold_B,threshold_C,threshold_D  )
-                
-                ecg_signal_noisy_A = cleaned_df['A']
-                ecg_signal_noisy_B = cleaned_df['B']
-                ecg_signal_noisy_C = cleaned_df['C']
-                ecg_signal_noisy_D = cleaned_df['D']
-                
-
-                ecg_signal_noisy_A = ecg_signal_noisy_A.to_numpy()
-                ecg_signal_noisy_B = ecg_signal_noisy_B.to_numpy()
-                ecg_signal_noisy_C = ecg_signal_noisy_C.to_numpy()
-                ecg_signal_noisy_D = ecg_signal_noisy_D.to_numpy()
-                
-            
-                # if start_index >= len(ecg_signal_noisy_B):
-                #     break  # Exit loop if start index exceeds data length              
-
-                ras_B = ecg_signal_noisy_B
-                ras_D = ecg_signal_noisy_D
-                ras_A = ecg_signal_noisy_A
-                ras_C = ecg_signal_noisy_C
-                
-                if len(ras_B) < 3000:
+                lap = timings.lap_timer()
+                batch = next(batches, None)
+                if batch is None:
                     break
-                
-                time_B, fhr_B, _, time_m_B, mhr_B, _ ,end_fetal_B,end_maternal_B,rms_main_B, rms_iso_B= process_of_code(ras_B, extra_B, start_index,last_foetal_B, last_maternal_B)
-                time_D, fhr_D, _, time_m_D,mhr_D, _ ,end_fetal_D,end_maternal_D,rms_main_D, rms_iso_D= process_of_code(ras_D, extra_D, start_index,last_foetal_D, last_maternal_D)
-                time_A, fhr_A, _, time_m_A, mhr_A, _ ,end_fetal_A,end_maternal_A,rms_main_A, rms_iso_A= process_of_code(ras_A, extra_A, start_index,last_foetal_A, last_maternal_A)
-                time_C, fhr_C, _, time_m_C,mhr_C, _ ,end_fetal_C,end_maternal_C,rms_main_C, rms_iso_C= process_of_code(ras_C, extra_C, start_index,last_foetal_C, last_maternal_C)
-
-
-                final_time_fhr_BD = time_B if len(time_B)>=len(time_D) else time_D
-                final_time_fhr_AC = time_A if len(time_A)>=len(time_C) else time_C
-                final_time_fhr = final_time_fhr_AC if len(final_time_fhr_AC)>=len(final_time_fhr_BD) else final_time_fhr_BD
-                
-                final_fhr_BD = fhr_B if len(time_B)>=len(time_D) else fhr_D
-                final_fhr_AC = fhr_A if len(time_A)>=len(time_C) else fhr_C
-                final_fhr = final_fhr_AC if len(final_time_fhr_AC)>=len(final_time_fhr_BD) else final_fhr_BD
-
-
-
-                final_time_mhr_BD = time_m_D if len(time_D) >= len(time_B) else time_m_B
-                final_time_mhr_AC = time_m_A if len(time_A) >= len(time_C) else time_m_C
-                final_time_mhr = final_time_mhr_AC if len(final_time_fhr_AC) >= len(final_time_fhr_BD) else final_time_mhr_BD
-
-                final_mhr_BD = mhr_D if len(time_D) >= len(time_B) else mhr_B
-                final_mhr_AC = mhr_A if len(time_A) >= len(time_C) else mhr_C
-                final_mhr = final_mhr_AC if len(final_time_fhr_AC) >= len(final_time_fhr_BD) else final_mhr_BD
+                lap('read')
+                samples_seen += len(batch)
+                start_index = samples_seen - 3000
+
+                print_batch_header(batch_num)
+
+                if profiler is not None:
+                    profiler.start(batch_num)
+                result = analyse_batch(batch, start_index, session, executor, timings)
+                if profiler is not None:
+                    profiler.stop(batch_num)
+                lap('batch')
+                if result is None:
+                    break
+                if hop:
+                    result = take_new_beats(result, last_reported)
 
-                
-                if len(time_D) == 0 and len(time_B) == 0 and len(time_A) == 0 and len(time_C):
-                    best_ECG = None
-                else:
-                    if len(time_D) >= max(len(time_B), len(time_C), len(time_A)):
-                        best_ECG = "TOP"
-                    elif len(time_B) >= max(len(time_D), len(time_C), len(time_A)):
-                        best_ECG = "BOTTOM"
-                    elif len(time_C) >= max(len(time_D), len(time_B), len(time_A)):
-                        best_ECG = "LEFT"
-                    elif len(time_A) >= max(len(time_D), len(time_B), len(time_C)):
-                        best_ECG = "RIGHT"
-
-                    # end_fetal = end_fetal_D if len(time_D) >= len(time_B)  else end_fetal_B
-                    # end_maternal = end_maternal_D if len(time_D) >= len(time_B)  else end_maternal_B
-
-
-                extra_B = ras_B[-2000:] #len =2000
-                extra_D = ras_D[-2000:] 
-                extra_A = ras_A[-2000:] #len =2000
-                extra_C = ras_C[-2000:] 
-
-                last_foetal_B = end_fetal_B
-                last_maternal_B = end_maternal_B
-
-                last_foetal_D = end_fetal_D
-                last_maternal_D = end_maternal_D 
-
-                last_foetal_A = end_fetal_A
-                last_maternal_A = end_maternal_A
-
-                last_foetal_C = end_fetal_C
-                last_maternal_C = end_maternal_C
-
-                for i in range(0, len(final_fhr)):
-                    if i == 0:
-                        final_fhr[i] = final_fhr[i]
-
-                    else:
-                        final_fhr[i] = int((final_fhr[i-1]+final_fhr[i])/2)
-
-                ##Adding for new laptop with new version
-
-                final_time_fhr = [float(x) for x in final_time_fhr]
-
-                total_FHR_points += len(final_time_fhr)   
-                total_fhr_var.extend(final_fhr) 
-                total_time_var.extend(final_time_fhr)  
-
-                total_MHR_points+=len(final_time_mhr)
-                total_mhr_time.extend(final_time_mhr)
-                toatl_mhr.extend(final_mhr)
-
-                # print(f"No of FHR in TOP sensor = {len(time_D)} ")
-                # print(f"No of FHR in BOTTOM sensor = {len(time_B)} ")
-                # print(f"No of FHR in RIGHT sensor = {len(time_A)} ")
-                # print(f"No of FHR in LEFT sensor = {len(time_C)} ")
-
-                                # Sort the RMS values
-                rms_main_B_sorted = sorted(rms_main_B)
-                rms_iso_B_sorted = sorted(rms_iso_B)
-                rms_main_D_sorted = sorted(rms_main_D)
-                rms_iso_D_sorted = sorted(rms_iso_D)
-
-                rms_main_A_sorted = sorted(rms_main_A)
-                rms_iso_A_sorted = sorted(rms_iso_A)
-                rms_main_C_sorted = sorted(rms_main_C)
-                rms_iso_C_sorted = sorted(rms_iso_C)
-
-                # Filter out the 2 max and 2 min values
-                rms_main_B_filtered = rms_main_B_sorted[2:-2]
-                rms_iso_B_filtered = rms_iso_B_sorted[2:-2]
-                rms_main_D_filtered = rms_main_D_sorted[2:-2]
-                rms_iso_D_filtered = rms_iso_D_sorted[2:-2]
-
-                rms_main_A_filtered = rms_main_A_sorted[2:-2]
-                rms_iso_A_filtered = rms_iso_A_sorted[2:-2]
-                rms_main_C_filtered = rms_main_C_sorted[2:-2]
-                rms_iso_C_filtered = rms_iso_C_sorted[2:-2]
-
-                # Calculate the average of the filtered values
-                avg_rms_main_B = np.mean(rms_main_B_filtered)
-                avg_rms_iso_B = np.mean(rms_iso_B_filtered)
-                avg_rms_main_D = np.mean(rms_main_D_filtered)
-                avg_rms_iso_D = np.mean(rms_iso_D_filtered)
-
-                # Calculate the average of the filtered values
-                avg_rms_main_A = np.mean(rms_main_A_filtered)
-                avg_rms_iso_A = np.mean(rms_iso_A_filtered)
-                avg_rms_main_C = np.mean(rms_main_C_filtered)
-                avg_rms_iso_C = np.mean(rms_iso_C_filtered)
-
-                Ratio_B = avg_rms_main_B/avg_rms_iso_B
-                Ratio_D = avg_rms_main_D/avg_rms_iso_D
-                Ratio_A = avg_rms_main_A/avg_rms_iso_A
-                Ratio_C = avg_rms_main_C/avg_rms_iso_C
-
-                print(f"Ratio bottom sensor = {Ratio_B}")
-                print(f"Ratio top sensor    = {Ratio_D}")
-                print(f"Ratio right sensor  = {Ratio_A}")
-                print(f"Ratio left sensor   = {Ratio_C}")
-
-                print()
-
-                print(f"Best ECG: {best_ECG}")
-                print()
-                print(f"Final_Time_FHR: {final_time_fhr}")  
-                print(f"Final_FHR: {final_fhr}")
-                    
-                print()          
-                print(f"Final_Time_MHR: {final_time_mhr}") 
-                print(f"Final_MHR: {final_mhr}")
-
-                file_name = "ICA for ALL sensors  2025-02-28- ECG_21 bilinear 2 _60Hz.txt"
-                with open(file_name, "a") as file:
-                    file.write( f"##################################################################\n")
-                    file.write(f"\n")
-                    file.write(f'Time slots {batch_num}\n')
-                    file.write(f"Best ECG: {best_ECG}\n")
-                    
-                    file.write(f"\n")
-                    file.write(f"Ratio bottom sensor = {round(Ratio_B, 2)}\n")
-                    file.write(f"Ratio top    sensor = {round(Ratio_D, 2)}\n")
-                    file.write(f"Ratio right  sensor = {round(Ratio_A, 2)}\n")
-                    file.write(f"Ratio left   sensor = {round(Ratio_C, 2)}\n")
-
-                    file.write(f"\n")
-                    file.write(f"Final_Time_FHR: {final_time_fhr}\n")
-                    file.write(f"Final_FHR: {final_fhr}\n")
-                    file.write(f"\n")
-                    file.write(f"Final_Time_MHR: {final_time_mhr}\n")
-                    file.write(f"Final_MHR: {final_mhr}\n")
-                    file.write(f"\n")
-                    
+                total_FHR_points += len(result['final_time_fhr'])   
+                total_fhr_var.extend(result['final_fhr']) 
+                total_time_var.extend(result['final_time_fhr'])  
 
+                total_MHR_points+=len(result['final_time_mhr'])
+                total_mhr_time.extend(result['final_time_mhr'])
+                toatl_mhr.extend(result['final_mhr'])
 
+                report_batch(batch_num, result, sink)
+                lap('report')
 
                 # if batch_num==1:
                 #     break
@@ -951,26 +2062,349 @@ def main():
 
 
 
-        print()
-        print("Total_FHR_points= ",total_FHR_points)
-        print(f"Total_FHR = {total_fhr_var}")
-        print()
-        print(f"Total_FHR_Time = {total_time_var}")
-        print()
-        print("Total_MHR_points= ",total_MHR_points)
-        print(f"Total_MHR={toatl_mhr}")
-        print()
-        print(f"Total_MHR_Time={total_mhr_time}")
-
-        
+        print_totals(total_time_var, total_fhr_var, total_mhr_time, toatl_mhr)
+        if timings.enabled:
+            logger.info("\n%s", timings.summary())
+        return True
 
     except KeyboardInterrupt:
-        print("Process interrupted by the user.")
+        logger.warning("Process interrupted by the user.")
+        return False
     
     except Exception as e:
         
-        print(f"An error occurred: {e}")
-        traceback.print_exc()
+        logger.exception("An error occurred: %s", e)
+        return False
+
+    finally:
+        sink.close()
+        if executor is not None:
+            executor.shutdown()
+        if profiler is not None:
+            profiler.close()
+
+async def run_pipeline(file_path='data/2025-02-28/21_ECG_WCTG.csv', mode=channel_mode, streaming=streaming_filters, warm_start=ica_warm_start,
+                       results_file="ICA for ALL sensors  2025-02-28- ECG_21 bilinear 2 _60Hz.txt", queue_size=4,
+                       separation=separation_mode, timed=collect_timings):
+    # Same output as main(), but reading, computing and reporting run as separate stages joined by bounded
+    # queues: a slow disk or terminal only fills the result queue, and compute stalls once both queues are full.
+    # Returns False if a stage failed, like main()
+    loop = asyncio.get_running_loop()
+    session = new_session(streaming, warm_start, separation=separation)
+    executor = make_channel_executor(mode) if separation == "channel" else None
+    sink = ResultsSink(results_file)
+    # Only the compute thread records into it
+    timings = StageTimings() if timed else no_timings
+    # One thread per stage, so each stage stays in order and none of them blocks the event loop
+    ingest_thread, compute_thread, output_thread = ThreadPoolExecutor(1), ThreadPoolExecutor(1), ThreadPoolExecutor(1)
+
+    batches = asyncio.Queue(maxsize=queue_size)
+    results = asyncio.Queue(maxsize=queue_size)
+    totals = ([], [], [], [])
+
+    async def ingest():
+        reader = iter_batches(file_path, 3000)
+        while True:
+            batch = await loop.run_in_executor(ingest_thread, next, reader, None)
+            await batches.put(batch)
+            if batch is None:
+                return
+
+    async def compute():
+        batch_num = 1
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            start_index = (batch_num - 1) * 3000
+            result = await loop.run_in_executor(compute_thread, analyse_batch, batch, start_index, session, executor, timings)
+            if result is None:
+                break
+            await results.put((batch_num, result))
+            batch_num += 1
+        await results.put(None)
+
+    def emit(batch_num, result):
+        print_batch_header(batch_num)
+        report_batch(batch_num, result, sink)
+
+    async def output():
+        while True:
+            item = await results.get()
+            if item is None:
+                return
+            batch_num, result = item
+            totals[0].extend(result['final_time_fhr'])
+            totals[1].extend(result['final_fhr'])
+            totals[2].extend(result['final_time_mhr'])
+            totals[3].extend(result['final_mhr'])
+            await loop.run_in_executor(output_thread, emit, batch_num, result)
+
+    tasks = [asyncio.create_task(stage()) for stage in (ingest, compute, output)]
+    try:
+        await asyncio.gather(*tasks)
+        print_totals(*totals)
+        if timings.enabled:
+            logger.info("\n%s", timings.summary())
+        return True
+    except Exception as e:
+        logger.exception("An error occurred: %s", e)
+        return False
+    finally:
+        # A failed stage leaves the others waiting on their queues, and compute can stop on a short
+        # batch while ingest still waits on a full queue
+        for task in tasks:
+            task.cancel()
+        for pool in (ingest_thread, compute_thread, output_thread):
+            pool.shutdown()
+        sink.close()
+        if executor is not None:
+            executor.shutdown()
+
+def socket_source(host, port, n_channels=4):
+    # Little-endian int32 frames of n_channels values from a TCP stream, yielded as soon as whole rows arrive
+    frame = 4 * n_channels
+    with socket.create_connection((host, port)) as sock:
+        pending = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            pending += data
+            n_rows = len(pending) // frame
+            if n_rows:
+                yield np.frombuffer(pending[:n_rows * frame], dtype='<i4').reshape(n_rows, n_channels)
+                pending = pending[n_rows * frame:]
+
+def pipe_source(path, block_rows=50):
+    # Text rows "A,B,C,D" from a named pipe (or any file), yielded block_rows rows at a time
+    rows = []
+    with open(path) as pipe:
+        for line in pipe:
+            if not line.strip():
+                continue
+            rows.append([int(value) for value in line.split(',')])
+            if len(rows) == block_rows:
+                yield np.array(rows)
+                rows = []
+    if rows:
+        yield np.array(rows)
+
+def simulated_source(file_path, block_rows=50, realtime=True):
+    # Replay a recording as a stand-in for the device, paced at fs unless realtime is off
+    started = time.perf_counter()
+    sent = 0
+    for block in iter_batches(file_path, block_rows):
+        sent += len(block)
+        if realtime:
+            delay = started + sent / fs - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield block
+
+def run_live(source, mode=channel_mode, streaming=streaming_filters, warm_start=ica_warm_start, results_file="live_results.txt",
+             hop=sliding_hop):
+    # Same batch analysis as main(), fed from a live source of (n_rows, 4) int blocks.
+    # Each completed 3000-sample window is reported with the delay since its last sample arrived.
+    # With a hop the window is analysed again after every hop new samples
+    check_hop(hop)
+    session = new_session(streaming, warm_start, sliding=bool(hop))
+    executor = make_channel_executor(mode)
+    sink = ResultsSink(results_file)
+
+    window = np.empty((3000, len(channel_names)), dtype=np.int64)
+    size = len(window)
+    filled = 0
+    samples_seen = 0
+    batch_num = 1
+    latencies = []
+    last_reported = {'fhr': -math.inf, 'mhr': -math.inf}
+
+    try:
+        for block in source:
+            arrived = time.perf_counter()
+            while len(block):
+                take = min(size - filled, len(block))
+                window[filled:filled + take] = block[:take]
+                filled += take
+                block = block[take:]
+                if filled < size:
+                    continue
+
+                samples_seen += size
+                start_index = samples_seen - len(window)
+
+                print_batch_header(batch_num)
+                result = analyse_batch(window[:size], start_index, session, executor)
+                if hop:
+                    result = take_new_beats(result, last_reported)
+                report_batch(batch_num, result, sink)
+                # Live results must reach the file as each window completes
+                sink.flush()
+
+                latency = time.perf_counter() - arrived
+                latencies.append(latency)
+                logger.info("Latency: %.1f ms", latency * 1000)
+
+                filled = 0
+                batch_num += 1
+                size = hop or len(window)
+
+    except KeyboardInterrupt:
+        logger.warning("Process interrupted by the user.")
+
+    finally:
+        sink.close()
+        if executor is not None:
+            executor.shutdown()
+
+    if latencies:
+        logger.info("\nWindows = %d, mean latency = %.1f ms, max latency = %.1f ms", len(latencies), np.mean(latencies) * 1000, np.max(latencies) * 1000)
+
+def expand_recordings(pattern):
+    # A directory means every CSV dump and binary recording directly inside it, anything else is a glob.
+    # A CSV dump that has been converted is left out, its binary recording (same stem) is the one processed
+    if os.path.isdir(pattern):
+        paths = glob.glob(os.path.join(pattern, '*.csv')) + glob.glob(os.path.join(pattern, '*' + recording_extension))
+    else:
+        paths = glob.glob(pattern)
+    converted = {os.path.splitext(path)[0] for path in paths if path.endswith(recording_extension)}
+    return sorted(path for path in paths if not (path.endswith('.csv') and os.path.splitext(path)[0] in converted))
+
+def recording_output_name(file_path):
+    # data/<date>/<name>.csv -> <date>_<name>.csv, recordings from different days share file names
+    parent = os.path.basename(os.path.dirname(os.path.abspath(file_path)))
+    return f"{parent}_{os.path.basename(file_path)}"
+
+def process_recording(file_path, out_dir):
+    # Runs in a pool worker: the channels stay serial because the pool already spreads the recordings.
+    # Returns (file_path, seconds, ok), the error itself is in the recording's log file
+    name = recording_output_name(file_path)
+    results_file = os.path.join(out_dir, name + '.txt')
+    log_file = os.path.join(out_dir, name + '.log')
+
+    open(results_file, 'w').close()
+    started = time.perf_counter()
+    with open(log_file, 'w') as log, contextlib.redirect_stdout(log):
+        ok = main(mode="serial", file_path=file_path, results_file=results_file)
+    return file_path, time.perf_counter() - started, ok
+
+def run_batch(pattern, out_dir='results', workers=None):
+    # Process many recordings at once, one per worker, each with its own results and log file.
+    # Returns the recordings that failed
+    paths = expand_recordings(pattern)
+    os.makedirs(out_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    get_filter_bank()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor, open(os.path.join(out_dir, 'timing.csv'), 'w', newline='') as timing:
+        writer = csv.writer(timing)
+        writer.writerow(['recording', 'seconds', 'status'])
+
+        failed = []
+        futures = {executor.submit(process_recording, path, out_dir): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                file_path, seconds, ok = future.result()
+            except Exception as e:
+                # The worker itself died, e.g. on a recording it could not open
+                file_path, seconds, ok = futures[future], math.nan, False
+                logger.error("%s: %s", file_path, e)
+            status = "ok" if ok else "failed"
+            if not ok:
+                failed.append(file_path)
+            writer.writerow([file_path, round(seconds, 3), status])
+            timing.flush()
+            logger.info("%s: %.1f s, %s", file_path, seconds, status)
+
+    logger.info("Processed %d recordings in %.1f s, %d failed", len(paths), time.perf_counter() - started, len(failed))
+    for file_path in sorted(failed):
+        logger.error("Failed: %s", file_path)
+    return failed
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Fetal and maternal heart rate from 4-channel abdominal ECG")
+    parser.add_argument("--log-level", default=log_level, help="DEBUG, INFO, WARNING, ERROR or CRITICAL")
+    parser.add_argument("--quiet", action="store_true", help="no console output at all, for maximum throughput")
+    commands = parser.add_subparsers(dest="command")
+
+    run = commands.add_parser("run", help="process one recording (default)")
+    run.add_argument("file_path", nargs="?", default='data/2025-02-28/21_ECG_WCTG.csv', help=f"CSV dump or {recording_extension} recording")
+    run.add_argument("--pipeline", action="store_true", help="overlap reading, computing and reporting in an asyncio pipeline")
+    run.add_argument("--mode", choices=("serial", "thread", "process"), default=channel_mode,
+                     help="how the channels of a batch are dispatched, multichannel separation always runs in this process")
+    run.add_argument("--results-file", default="ICA for ALL sensors  2025-02-28- ECG_21 bilinear 2 _60Hz.txt",
+                     help="results file, .jsonl and .csv give machine-readable output")
+    run.add_argument("--hop", type=int, default=sliding_hop,
+                     help="analyse a sliding 3000-sample window every HOP samples instead of back-to-back batches")
+    run.add_argument("--separation", choices=("channel", "multichannel"), default=separation_mode,
+                     help="one ICA per electrode, or one ICA of all electrodes together")
+    run.add_argument("--no-timings", dest="timed", action="store_false", help="skip the per-stage timing summary")
+    run.add_argument("--profile-batches", metavar="FIRST:LAST", help="run cProfile over these batch numbers")
+    run.add_argument("--profile-output", default="ICA.prof", help="where the cProfile stats are written")
+
+    convert = commands.add_parser("convert", help=f"convert CSV dumps to {recording_extension} recordings")
+    convert.add_argument("csv_paths", nargs="+")
+
+    batch = commands.add_parser("batch", help="process every recording in a directory or glob with a process pool")
+    batch.add_argument("pattern", help="directory or glob, e.g. 'data/*/*.csv'")
+    batch.add_argument("--out-dir", default="results")
+    batch.add_argument("--workers", type=int, default=None)
+
+    live = commands.add_parser("live", help="process a live 4-channel stream as it arrives")
+    sources = live.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--tcp", metavar="HOST:PORT", help="int32 little-endian frames over TCP")
+    sources.add_argument("--pipe", metavar="PATH", help="'A,B,C,D' text rows from a named pipe")
+    sources.add_argument("--simulate", metavar="FILE", help="replay a recording at the sampling rate")
+    live.add_argument("--results-file", default="live_results.txt", help="results file, .jsonl and .csv give machine-readable output")
+    live.add_argument("--hop", type=int, default=sliding_hop,
+                      help="analyse a sliding 3000-sample window every HOP samples instead of back-to-back batches")
+
+    args = parser.parse_args(argv)
+    configure_logging("quiet" if args.quiet else args.log_level)
+    if args.command in ("run", "live"):
+        try:
+            check_hop(args.hop)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.command == "run" and args.pipeline and args.hop:
+        parser.error("--pipeline does not support --hop")
+    if args.command == "run" and args.pipeline and args.profile_batches:
+        parser.error("--pipeline does not support --profile-batches")
+
+    if args.command == "convert":
+        for csv_path in args.csv_paths:
+            logger.info("%s", convert_csv_to_recording(csv_path))
+    elif args.command == "live":
+        if args.tcp:
+            host, port = args.tcp.rsplit(':', 1)
+            source = socket_source(host, int(port))
+        elif args.pipe:
+            source = pipe_source(args.pipe)
+        else:
+            source = simulated_source(args.simulate)
+        run_live(source, results_file=args.results_file, hop=args.hop)
+    elif args.command == "batch":
+        if run_batch(args.pattern, args.out_dir, args.workers):
+            return 1
+    elif args.command == "run" and args.pipeline:
+        if not asyncio.run(run_pipeline(args.file_path, args.mode, results_file=args.results_file, separation=args.separation, timed=args.timed)):
+            return 1
+    elif args.command == "run":
+        profiler = None
+        if args.profile_batches:
+            first, last = args.profile_batches.split(':')
+            profiler = BatchProfiler(int(first), int(last), args.profile_output)
+            # cProfile only sees this process, worker processes would leave the channel work out of the profile
+            if args.mode == "process":
+                logger.warning("Profiling runs the channels serially, the process workers would not be profiled")
+                args.mode = "serial"
+        if not main(mode=args.mode, file_path=args.file_path, results_file=args.results_file, timed=args.timed, profiler=profiler, hop=args.hop, separation=args.separation):
+            return 1
+    else:
+        if not main():
+            return 1
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(cli())
\ No newline at end of file
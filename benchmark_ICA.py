@@ -0,0 +1,162 @@
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+import ICA
+
+########################################################################
+# Throughput of the per-batch pipeline stages on synthetic maternal + fetal ECG.
+# Run from the same directory as ICA.py (it needs filters/):
+#     python benchmark_ICA.py --batches 20 --repeat 5
+# Every stage is reported in samples/sec and batches/sec, and as a multiple of real time (fs samples/sec)
+
+batch_size = 3000
+
+def ecg_beats(n, rate, amplitude, width, rng, jitter=0.02):
+    # Gaussian R wave with a small S dip for every beat, beat-to-beat interval jittered by a few percent
+    t = np.arange(n) / ICA.fs
+    signal = np.zeros(n)
+    period = 60 / rate
+    beat = 0.3
+    while beat < t[-1]:
+        signal += amplitude * np.exp(-((t - beat) / width) ** 2)
+        signal -= 0.3 * amplitude * np.exp(-((t - beat - 0.02) / width) ** 2)
+        beat += period * (1 + jitter * rng.standard_normal())
+    return signal
+
+def voltage_to_quantized_value(voltage, v_min=-3.3, v_max=3.3, bit_depth=24):
+    # Inverse of ICA.quantized_value_to_voltage, voltage in mV
+    step_size = (v_max - v_min) / (2**bit_depth - 1)
+    return np.round((voltage / 1e3 - v_min) / step_size).astype(np.int32)
+
+def synthetic_recording(n_batches, seed=0, maternal_rate=78, fetal_rate=140):
+    # (n_batches * 3000, 4) int32 samples: maternal and fetal ECG with a different maternal
+    # amplitude per electrode, baseline wander, mains hum, white noise and a few ADC glitches
+    rng = np.random.default_rng(seed)
+    n = n_batches * batch_size
+    t = np.arange(n) / ICA.fs
+    columns = []
+    for k in range(len(ICA.channel_names)):
+        maternal = ecg_beats(n, maternal_rate, 0.5 * (k + 1), 0.012, rng)
+        fetal = ecg_beats(n, fetal_rate, 0.15, 0.008, rng)
+        noise = 0.02 * rng.standard_normal(n) + 0.2 * np.sin(2 * np.pi * 0.3 * t) + 0.05 * np.sin(2 * np.pi * 50 * t)
+        quantized = voltage_to_quantized_value(maternal + fetal + noise)
+        quantized[rng.integers(0, n, 2 * n_batches)] += 200000
+        columns.append(quantized)
+    return np.column_stack(columns)
+
+def time_call(func, repeat):
+    # Median wall time of repeat calls, after one warm-up call
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+def report(name, seconds, n_samples):
+    rate = n_samples / seconds
+    print(f"{name:<28}{seconds * 1e3:>10.2f} ms{rate:>14,.0f}{rate / batch_size:>12.1f}{rate / ICA.fs:>10.1f}x")
+
+def stage_inputs(batch, channel='B'):
+    # The intermediate signals of one channel of one batch (and the stack of all its channels), built the same way as process_of_code
+    # builds them, so every stage below is timed on the data it sees in the pipeline
+    raw = batch[:, ICA.channel_names.index(channel)]
+    stack = ICA.quantized_value_to_voltage(ICA.remove_outliers(batch.T))
+    chain = ICA.StreamingFilterChain()
+    samples = ICA.quantized_value_to_voltage(ICA.remove_outliers(raw.astype(float)))
+    signal = chain.filter(samples)
+
+    r_indices, _, _ = ICA.adt_findrpeaks(signal)
+    qrs_mask, _ = ICA.qrs_windows(signal, r_indices, int(0.65 * 24), int(1.5 * 24))
+    main_signal = np.where(qrs_mask, signal, 0.0)
+    residual_signal = ICA.fill_zero_runs(signal - main_signal)
+    main_signal[main_signal == 0] = np.mean(residual_signal[residual_signal != 0])
+    data = np.vstack((main_signal, residual_signal, signal)).T
+
+    components = ICA.IcaStage(warm_start=False).fit_transform(data)
+    separated = [ICA.correct_sign(components[:, i])[50:2950] for i in range(2)]
+    entropies = [ICA.component_irregularity(s) for s in separated]
+    fetal = int(np.argmax(entropies))
+
+    hr_bpm, fhr_indices, _, _, _, _, _ = ICA.get_hrlis(separated[fetal], 0, threshold_ratio=0.4, refractory_period=160)
+    _, mhr_indices, _, _, mhr_bpm, _, _ = ICA.get_hrlis(separated[1 - fetal], 0, threshold_ratio=0.4, refractory_period=160)
+    fhr_indices = [x + 18 for x in fhr_indices]
+    mhr_indices = [x + 18 for x in mhr_indices]
+    fhr_indices_new, fhr_bpm_new = ICA.missed_peaks(fhr_indices, hr_bpm, mhr_indices)
+
+    _, maternal_indices, _, _, _, _, _ = ICA.get_hrlis(signal, 0, threshold_ratio=0.4, refractory_period=160)
+    return {'raw': raw, 'samples': samples, 'stack': stack, 'signal': signal, 'data': data, 'separated': separated[fetal],
+            'fhr_indices': fhr_indices, 'fhr_bpm': hr_bpm, 'mhr_indices': mhr_indices,
+            'fhr_indices_new': fhr_indices_new, 'median': np.median(fhr_bpm_new),
+            'residual': residual_signal, 'mhr_indices_adjusted': [x + 140 for x in maternal_indices[1:]]}
+
+def stage_benchmarks(inputs):
+    # name -> (callable, samples processed per call)
+    n = len(inputs['raw'])
+
+    def filter_chain():
+        ICA.StreamingFilterChain().filter(inputs['samples'])
+
+    def filter_channels():
+        for row in inputs['stack']:
+            ICA.StreamingFilterChain().filter(row)
+
+    def filter_stack():
+        ICA.StreamingFilterChain().filter(inputs['stack'])
+
+    def missed():
+        fhr_indices_new, _ = ICA.missed_peaks(inputs['fhr_indices'], inputs['fhr_bpm'], inputs['mhr_indices'])
+        ICA.missed_thresh(fhr_indices_new, inputs['separated'], inputs['median'])
+
+    return {
+        'remove_outliers': (lambda: ICA.remove_outliers(inputs['raw'].astype(float)), n),
+        'filter chain': (filter_chain, n),
+        'filter 4 channels, 1 by 1': (filter_channels, inputs['stack'].size),
+        'filter 4 channels, stacked': (filter_stack, inputs['stack'].size),
+        'adt_findrpeaks': (lambda: ICA.adt_findrpeaks(inputs['signal']), n),
+        'FastICA fit': (lambda: ICA.IcaStage(solver="fastica", warm_start=False).fit_transform(inputs['data']), n),
+        'sample_entropy': (lambda: ICA.sample_entropy(inputs['separated'], 1), n),
+        'missed_peaks/missed_thresh': (missed, n),
+        'peak_separation_ie': (lambda: ICA.peak_separation_ie(inputs['residual'], inputs['mhr_indices_adjusted']), n),
+    }
+
+def run_recording(recording, mode, streaming, warm_start):
+    # Every batch of the recording through analyse_batch, with a fresh session and pool
+    session = ICA.new_session(streaming, warm_start)
+    executor = ICA.make_channel_executor(mode)
+    try:
+        for start in range(0, len(recording) - batch_size + 1, batch_size):
+            ICA.analyse_batch(recording[start:start + batch_size], start, session, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def main(n_batches=20, repeat=5, mode="serial", streaming=True, warm_start=True, seed=0):
+    ICA.configure_logging("quiet")
+    recording = synthetic_recording(n_batches, seed)
+
+    print(f"{'stage':<28}{'per call':>13}{'samples/s':>14}{'batches/s':>12}{'realtime':>11}")
+    # Stages are timed on the middle batch of channel B, past the start-up of the filters
+    middle = (n_batches // 2) * batch_size
+    inputs = stage_inputs(recording[middle:middle + batch_size])
+    for name, (func, n_samples) in stage_benchmarks(inputs).items():
+        report(name, time_call(func, repeat), n_samples)
+
+    # The whole recording, four channels per batch, including pool start-up for the process mode
+    seconds = time_call(lambda: run_recording(recording, mode, streaming, warm_start), max(1, repeat // 2))
+    report(f"4-channel batch ({mode})", seconds / n_batches, batch_size)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the fetal ECG pipeline stages on synthetic data")
+    parser.add_argument('--batches', type=int, default=20, help="length of the synthetic recording in 3000-sample batches")
+    parser.add_argument('--repeat', type=int, default=5, help="timed calls per stage, the median is reported")
+    parser.add_argument('--mode', choices=("serial", "thread", "process"), default="serial", help="channel dispatch for the full batch")
+    parser.add_argument('--no-streaming', dest='streaming', action='store_false', help="re-filter the previous 2000 samples every batch")
+    parser.add_argument('--no-warm-start', dest='warm_start', action='store_false', help="start every ICA fit from a random matrix")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args.batches, args.repeat, args.mode, args.streaming, args.warm_start, args.seed)